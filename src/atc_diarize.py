@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: Copyright © <2022> Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Juan Zuluaga-Gomez <jzuluaga@idiap.ch>
+#
+# SPDX-License-Identifier: MIT-License
+
+"""
+    Single command line front-end for text-based diarization:
+
+        atc-diarize train  ...   (train_diarization.py)
+        atc-diarize eval   ...   (eval_diarization.py)
+        atc-diarize infer  ...   (inference_diarization.py)
+        atc-diarize mdtm   ...   (create_mdtm_file.py)
+        atc-diarize rttm   ...   (convert_mdtm_to_rttm.py)
+
+    Only the module of the subcommand is imported, so the conversion
+    subcommands (mdtm, rttm) do not pay the import of torch or transformers.
+    Keep this file free of heavy imports.
+"""
+
+import importlib
+import sys
+
+# subcommand: (module, description)
+SUBCOMMANDS = {
+    "train": ("train_diarization", "train a text-based diarization model"),
+    "eval": ("eval_diarization", "evaluate a model on utt2text_tags files"),
+    "infer": ("inference_diarization", "tag text files (or run as a server)"),
+    "mdtm": ("create_mdtm_file", "create mdtm segments from the tags and the ASR ctm"),
+    "rttm": ("convert_mdtm_to_rttm", "convert a mdtm file to rttm"),
+}
+
+
+def usage():
+    lines = ["usage: atc-diarize <subcommand> [options]", "", "subcommands:"]
+    lines += [
+        f"  {name:<6} {description}"
+        for name, (_, description) in SUBCOMMANDS.items()
+    ]
+    lines += ["", "Run 'atc-diarize <subcommand> --help' to see its options."]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    """Dispatch the arguments to the main of the subcommand"""
+    argv = sys.argv[1:] if argv is None else argv
+
+    if len(argv) == 0 or argv[0] in ("-h", "--help"):
+        print(usage())
+        return 0
+    if argv[0] not in SUBCOMMANDS:
+        print(f"atc-diarize: unknown subcommand '{argv[0]}'\n\n{usage()}", file=sys.stderr)
+        return 2
+
+    name, subcommand_argv = argv[0], argv[1:]
+    module = importlib.import_module(SUBCOMMANDS[name][0])
+
+    # the program name in the help messages of argparse
+    sys.argv[0] = f"atc-diarize {name}"
+    if hasattr(module, "parse_args"):
+        module.main(module.parse_args(subcommand_argv))
+    else:
+        module.main(subcommand_argv)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: Copyright © <2022> Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Juan Zuluaga-Gomez <jzuluaga@idiap.ch>
+#
+# SPDX-License-Identifier: MIT-License
+
+"""
+    Memory benchmark of ATCDataset_diarization. Synthetic encodings (random
+    subword ids, like a non-padded tokenizer output) are stored:
+        - 'lists': as lists of lists, one torch.tensor per key built at each access
+          (the previous implementation of ATCDataset_diarization)
+        - 'columnar': in flat int32 tensors plus offsets (ATCDataset_diarization)
+    Each implementation runs in its own process. The RSS after building the dataset
+    and the samples per second (random access) are reported.
+"""
+
+import argparse
+import gc
+import json
+import random
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+
+from diarization_utils import ATCDataset_diarization
+
+
+class ListATCDataset_diarization(torch.utils.data.Dataset):
+    """Previous ATCDataset_diarization, the encodings are lists of lists"""
+
+    def __init__(self, encodings, labels):
+        self.encodings = encodings
+        self.labels = labels
+
+    def __getitem__(self, idx):
+        item = {key: torch.tensor(val[idx]) for key, val in self.encodings.items()}
+        item["labels"] = torch.tensor(self.labels[idx])
+        return item
+
+    def __len__(self):
+        return len(self.labels)
+
+
+def get_rss():
+    """Resident set size of the process, in MB"""
+    with open("/proc/self/status", "r") as rd:
+        for line in rd:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def synthetic_encodings(nb_samples, min_length=5, max_length=40, seed=1234):
+    """Encodings (input_ids, token_type_ids, attention_mask) and labels of random lengths"""
+    rng = random.Random(seed)
+    encodings = {"input_ids": [], "token_type_ids": [], "attention_mask": []}
+    labels = []
+    for _ in range(nb_samples):
+        length = rng.randint(min_length, max_length)
+        encodings["input_ids"].append(
+            [101] + [rng.randrange(1000, 30000) for _ in range(length - 2)] + [102]
+        )
+        encodings["token_type_ids"].append([0] * length)
+        encodings["attention_mask"].append([1] * length)
+        labels.append([-100] + [rng.randrange(5) for _ in range(length - 2)] + [-100])
+    return encodings, labels
+
+
+def run(implementation, nb_samples, nb_reads):
+    """Build one dataset and measure it, returns a dict with the results"""
+    rss_start = get_rss()
+    encodings, labels = synthetic_encodings(nb_samples)
+    if implementation == "lists":
+        dataset = ListATCDataset_diarization(encodings, labels)
+    else:
+        dataset = ATCDataset_diarization(encodings, labels)
+    # only the dataset is kept
+    del encodings, labels
+    gc.collect()
+    rss = get_rss() - rss_start
+
+    indices = np.random.default_rng(0).integers(0, len(dataset), nb_reads)
+    start = time.perf_counter()
+    for idx in indices:
+        dataset[int(idx)]
+    elapsed = time.perf_counter() - start
+
+    return {"rss": rss, "samples_per_second": nb_reads / elapsed}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-n",
+        "--nb-samples",
+        type=int,
+        default=1000000,
+        help="Number of synthetic utterances in the dataset",
+    )
+    parser.add_argument(
+        "--nb-reads",
+        type=int,
+        default=200000,
+        help="Number of (random) samples read to measure the speed",
+    )
+    parser.add_argument(
+        "--implementation",
+        choices=["lists", "columnar"],
+        default=None,
+        help="Run only one implementation (used internally, each one runs in its own process)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(args):
+    """Main code execution"""
+
+    if args.implementation is not None:
+        print(json.dumps(run(args.implementation, args.nb_samples, args.nb_reads)))
+        return
+
+    print(f"{'dataset':>10} | {'RSS (MB)':>9} | {'samples/s':>10}")
+    for implementation in ["lists", "columnar"]:
+        output = subprocess.run(
+            [sys.executable, __file__]
+            + ["--implementation", implementation]
+            + ["--nb-samples", str(args.nb_samples), "--nb-reads", str(args.nb_reads)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results = json.loads(output.splitlines()[-1])
+        print(
+            f"{implementation:>10} | {results['rss']:9.1f} | {results['samples_per_second']:10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: Copyright © <2022> Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Juan Zuluaga-Gomez <jzuluaga@idiap.ch>
+#
+# SPDX-License-Identifier: MIT-License
+
+"""
+    Speed benchmark of the alignment of the word tags to the subwords:
+        - 'loop': previous encode_tags, one numpy array per line built from the
+          offset mapping (misaligned lines are dropped)
+        - 'vectorized': align_tags, one pass over the word ids of the corpus
+    The lines of a utt2text_tags file are repeated up to '--nb-lines' and tokenized
+    once (not timed). The labels of both versions are checked to be the same.
+"""
+
+import argparse
+import time
+
+import numpy as np
+from transformers import AutoTokenizer
+
+from diarization_utils import (
+    align_tags,
+    read_atc_diarization_data,
+    read_atc_diarization_tags,
+)
+
+
+def encode_tags_loop(tag2id, tags, encodings):
+    """Previous encode_tags, returns None for the misaligned lines"""
+    labels = [[tag2id[tag] for tag in doc] for doc in tags]
+    encoded_labels = []
+    for doc_labels, doc_offset in zip(labels, encodings.offset_mapping):
+        doc_enc_labels = np.ones(len(doc_offset), dtype=int) * -100
+        arr_offset = np.array(doc_offset)
+        try:
+            doc_enc_labels[
+                (arr_offset[:, 0] == 0) & (arr_offset[:, 1] != 0)
+            ] = doc_labels
+        except ValueError:
+            encoded_labels.append(None)
+            continue
+        encoded_labels.append(doc_enc_labels.tolist())
+    return encoded_labels
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-m",
+        "--input-model",
+        default="bert-base-uncased",
+        help="Model (or tokenizer) folder or name on the HuggingFace hub",
+    )
+    parser.add_argument(
+        "-n",
+        "--nb-lines",
+        type=int,
+        default=1000000,
+        help="Number of lines, the lines of the input file are repeated",
+    )
+    parser.add_argument(
+        "input_file",
+        help="utt2text_tags file",
+    )
+    return parser.parse_args(argv)
+
+
+def main(args):
+    """Main code execution"""
+
+    tokenizer = AutoTokenizer.from_pretrained(
+        args.input_model, use_fast=True, do_lower_case=True
+    )
+    tag2id = {
+        tag: id
+        for id, tag in enumerate(
+            sorted(read_atc_diarization_tags(args.input_file) | {"O"})
+        )
+    }
+
+    texts, tags = read_atc_diarization_data(args.input_file)
+    repeats = -(-args.nb_lines // len(texts))
+    texts, tags = (texts * repeats)[: args.nb_lines], (tags * repeats)[: args.nb_lines]
+
+    print(f"Tokenizing {len(texts)} lines")
+    encodings = tokenizer(
+        texts,
+        is_split_into_words=True,
+        return_offsets_mapping=True,
+        truncation=True,
+    )
+
+    start = time.perf_counter()
+    loop_labels = encode_tags_loop(tag2id, tags, encodings)
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    labels, mismatches = align_tags(tag2id, tags, encodings)
+    vectorized_time = time.perf_counter() - start
+
+    mismatches = set(mismatches)
+    same = all(
+        (expected is None and idx in mismatches) or expected == label.tolist()
+        for idx, (expected, label) in enumerate(zip(loop_labels, labels))
+    )
+    print(f"{'version':>10} | {'time (s)':>8} | {'lines/s':>10}")
+    for name, elapsed in [("loop", loop_time), ("vectorized", vectorized_time)]:
+        print(f"{name:>10} | {elapsed:8.3f} | {len(texts) / elapsed:10.0f}")
+    print(
+        f"Speed-up: {loop_time / vectorized_time:.1f}x, misaligned lines: "
+        f"{len(mismatches)}, same labels: {same}"
+    )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: Copyright © <2022> Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Juan Zuluaga-Gomez <jzuluaga@idiap.ch>
+#
+# SPDX-License-Identifier: MIT-License
+
+"""
+    Startup benchmark of the atc-diarize command. It runs a command (by default
+    'atc-diarize rttm --help') several times in new processes, and fails
+    (exit code 1) if the median wall time is over the budget.
+    It catches heavy imports (torch, transformers...) leaking in the light subcommands.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ATC_DIARIZE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "atc-diarize"
+)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=0.5,
+        help="Maximum median startup time, in seconds",
+    )
+    parser.add_argument(
+        "--runs", type=int, default=10, help="Number of runs of the command"
+    )
+    parser.add_argument(
+        "--subcommand",
+        default="rttm --help",
+        help="Arguments of atc-diarize that are timed",
+    )
+    return parser.parse_args(argv)
+
+
+def main(args):
+    """Main code execution"""
+
+    command = [sys.executable, ATC_DIARIZE] + args.subcommand.split()
+
+    times = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+
+    median = statistics.median(times)
+    print(
+        f"'atc-diarize {args.subcommand}': median {median:.3f} s, "
+        f"min {min(times):.3f} s, max {max(times):.3f} s ({args.runs} runs, budget: {args.budget} s)"
+    )
+    if median > args.budget:
+        print("The startup time is over the budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
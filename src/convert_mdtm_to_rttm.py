@@ -7,19 +7,15 @@
 # SPDX-License-Identifier: MIT-License
 import argparse
 import os
-import shutil
 import sys
-from glob import glob
 
-import numpy as np
 
-
-def main():
+def main(argv=None):
 
     parser = argparse.ArgumentParser(description="Convert mdtm files to rttm")
     parser.add_argument("-i", "--input", required=True, help="The input mdtm file.")
     parser.add_argument("-o", "--output", required=True, help="The output rttm file.")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if not os.path.exists(args.input):
         print("Input file does not exist!")
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: Copyright © <2022> Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Juan Zuluaga-Gomez <jzuluaga@idiap.ch>
+#
+# SPDX-License-Identifier: MIT-License
+
+"""
+    Script to prepare a trained text-based diarization model for a fast, offline
+    cold start:
+        - the weights are stored in safetensors format (model.safetensors), that
+          inference_diarization.py and eval_diarization.py memory-map
+        - the tokenizer is saved next to the model, so it is not fetched from
+          the HuggingFace hub (bert-base-uncased) at startup
+"""
+
+import argparse
+import os
+
+from safetensors.torch import save_file
+
+from diarization_engine import (
+    SAFETENSORS_NAME,
+    load_token_classification_model,
+    load_tokenizer,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-m",
+        "--input-model",
+        required=True,
+        help="Folder where the final model is stored, model.safetensors is written in it",
+    )
+    return parser.parse_args()
+
+
+def main(args):
+    """Main code execution"""
+
+    model = load_token_classification_model(args.input_model)
+    path_to_weights = os.path.join(args.input_model, SAFETENSORS_NAME)
+
+    # safetensors does not store shared tensors, each one is saved contiguous.
+    # The file is replaced at the end, it can be memory-mapped by other processes
+    state_dict = {
+        name: tensor.contiguous() for name, tensor in model.state_dict().items()
+    }
+    save_file(state_dict, path_to_weights + ".tmp", metadata={"format": "pt"})
+    os.replace(path_to_weights + ".tmp", path_to_weights)
+    print(f"Weights saved in: {path_to_weights}")
+
+    # the tokenizer is loaded from the model folder if it is there
+    tokenizer = load_tokenizer(args.input_model)
+    tokenizer.save_pretrained(args.input_model)
+    print(f"Tokenizer saved in: {args.input_model}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -7,13 +7,9 @@
 # SPDX-License-Identifier: MIT-License
 import argparse
 import os
-import sys
-from glob import glob
 
-import numpy as np
 
-
-def main():
+def main(argv=None):
 
     parser = argparse.ArgumentParser(
         description="Create mdtm format diarization segments from NER and ASR hypothesis"
@@ -41,7 +37,7 @@ def main():
         help="If set scale the segment duration based on this patameter (Default: 1).",
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     for name in [args.hypothesis, args.tags, args.segments]:
         if not os.path.exists(name):
             print(name + " does not exist!")
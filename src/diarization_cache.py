@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: Copyright © <2022> Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Juan Zuluaga-Gomez <jzuluaga@idiap.ch>
+#
+# SPDX-License-Identifier: MIT-License
+
+"""
+    Cache of diarization results. ATC communications are very formulaic
+    ("roger", "wilco", read-backs...), so the same word sequence is tagged
+    many times. The results are cached with a key made of the cleaned words and
+    a fingerprint of the model:
+        - in memory, with a LRU policy and a maximum size in bytes
+        - optionally on disk (sqlite), shared across runs and processes
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# float weights of a fine-tuned model: the ones saved by the Trainer, or the
+# safetensors file if the model only has this one
+FLOAT_WEIGHTS_NAMES = ("pytorch_model.bin", "model.safetensors")
+
+
+def model_fingerprint(path_to_model, *extra):
+    """Fingerprint of a model folder: content of the config plus the name, size
+    and modification time of the weight files. 'extra' are other options that
+    change the outputs (e.g., backend or quantization)
+    """
+    fingerprint = hashlib.sha1()
+    for name in sorted(os.listdir(path_to_model)):
+        path_to_file = os.path.join(path_to_model, name)
+        if not os.path.isfile(path_to_file):
+            continue
+        if name == "config.json":
+            with open(path_to_file, "rb") as rd:
+                fingerprint.update(rd.read())
+        elif name.endswith((".bin", ".safetensors", ".onnx", ".pt")):
+            stat = os.stat(path_to_file)
+            fingerprint.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+
+    fingerprint.update(repr(extra).encode())
+    return fingerprint.hexdigest()
+
+
+def weights_fingerprint(path_to_model, *extra):
+    """Fingerprint of the float model only: content of the config and of the float
+    weights (the first of FLOAT_WEIGHTS_NAMES in the folder). The files derived
+    from the model (int8, onnx, safetensors copy, torchscript) do not change it,
+    so it is used as key of these derived files
+    """
+    fingerprint = hashlib.sha1()
+    for name in ("config.json",) + FLOAT_WEIGHTS_NAMES:
+        path_to_file = os.path.join(path_to_model, name)
+        if not os.path.isfile(path_to_file):
+            continue
+        fingerprint.update(name.encode())
+        with open(path_to_file, "rb") as rd:
+            for chunk in iter(lambda: rd.read(1024**2), b""):
+                fingerprint.update(chunk)
+        if name != "config.json":
+            break
+
+    fingerprint.update(repr(extra).encode())
+    return fingerprint.hexdigest()
+
+
+class ResultCache:
+    """\
+    LRU cache of tag ids (stored as bytes), keyed by the words of the utterance
+    and the model fingerprint. The entries are evicted when the cache exceeds 'max_bytes'.
+    If 'path_to_db' is given, the results are also stored in a sqlite file.
+    """
+
+    def __init__(self, fingerprint, max_bytes=64 * 1024**2, path_to_db=None):
+        self.fingerprint = fingerprint
+        self.max_bytes = max_bytes
+        self.path_to_db = path_to_db
+
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits, self.misses = 0, 0
+
+        # the sqlite connection is opened per process (workers are forked),
+        # and shared by the threads of the process (see diarization_pipeline.py)
+        self._db, self._db_pid = None, None
+        self.lock = threading.Lock()
+
+    @property
+    def db(self):
+        if self.path_to_db is None:
+            return None
+        if self._db_pid != os.getpid():
+            self._db = sqlite3.connect(
+                self.path_to_db, timeout=60, check_same_thread=False
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, tags BLOB)"
+            )
+            self._db_pid = os.getpid()
+        return self._db
+
+    def key(self, words):
+        text = self.fingerprint + "\n" + " ".join(words)
+        return hashlib.sha1(text.encode("utf8")).hexdigest()
+
+    def _add(self, key, tags):
+        if key in self.entries:
+            return
+        self.entries[key] = tags
+        self.size += len(key) + len(tags)
+
+        while self.size > self.max_bytes and len(self.entries) > 0:
+            old_key, old_tags = self.entries.popitem(last=False)
+            self.size -= len(old_key) + len(old_tags)
+
+    def get(self, key):
+        """Get the tag ids (bytes) of a key, or None if it is not cached"""
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
+        tags = self.entries.get(key)
+        if tags is not None:
+            self.entries.move_to_end(key)
+        elif self.db is not None:
+            row = self.db.execute(
+                "SELECT tags FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                tags = row[0]
+                self._add(key, tags)
+        return tags
+
+    def put(self, key, tags):
+        with self.lock:
+            self._add(key, tags)
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO results (key, tags) VALUES (?, ?)",
+                    (key, tags),
+                )
+
+    def flush(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+
+    def reset_stats(self):
+        self.hits, self.misses = 0, 0
+
+    def report(self):
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total > 0 else 0.0
+        return f"Cache hits: {self.hits}, misses: {self.misses} (hit rate: {rate:.1f}%)"
+
+
+class CachedEngine:
+    """\
+    Wrapper of DiarizationEngine that looks up the results in a ResultCache
+    before running the model. Only the utterances that are not cached
+    (and unique within the batch) go through the forward pass.
+    """
+
+    def __init__(self, engine, cache):
+        self.engine = engine
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def prepare(self, batch_words):
+        keys = [self.cache.key(words) for words in batch_words]
+        results = {}
+        for key in keys:
+            if key not in results:
+                results[key] = self.cache.get(key)
+
+        # hits are the utterances that do not need the forward pass
+        nb_hits = sum(results[key] is not None for key in keys)
+        self.cache.hits += nb_hits
+        self.cache.misses += len(keys) - nb_hits
+
+        # run the model only once per unique word sequence not found in the cache
+        missing = OrderedDict(
+            (key, words)
+            for key, words in zip(keys, batch_words)
+            if results[key] is None
+        )
+        state = {"words": batch_words, "keys": keys, "results": results}
+        state["missing"] = missing
+        if len(missing) > 0:
+            state["engine"] = self.engine.prepare(list(missing.values()))
+        return state
+
+    def run(self, state):
+        if len(state["missing"]) > 0:
+            self.engine.run(state["engine"])
+        return state
+
+    def finish(self, state):
+        results = state["results"]
+        if len(state["missing"]) > 0:
+            predictions = self.engine.finish(state["engine"])
+            for key, prediction in zip(state["missing"], predictions):
+                results[key] = prediction["tag_ids"].astype(np.int8).tobytes()
+                self.cache.put(key, results[key])
+
+        outputs = []
+        for key, words in zip(state["keys"], state["words"]):
+            tag_ids = np.frombuffer(results[key], dtype=np.int8).astype(np.int64)
+            outputs.append({"text": words[: len(tag_ids)], "tag_ids": tag_ids})
+        return outputs
+
+    def predict(self, batch_words):
+        return self.finish(self.run(self.prepare(batch_words)))
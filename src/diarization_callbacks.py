@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: Copyright © <2022> Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Juan Zuluaga-Gomez <jzuluaga@idiap.ch>
+#
+# SPDX-License-Identifier: MIT-License
+
+"""
+    Trainer callbacks for train_diarization.py, used with early stopping:
+        - the model is only saved when the validation metric improves
+        - the evaluations get sparser while the metric does not improve
+"""
+
+import operator
+
+from transformers import TrainerCallback
+
+
+class SparseEvaluationCallback(TrainerCallback):
+    """\
+    Evaluate every 'eval_steps' while the metric improves. After each evaluation
+    without improvement the interval doubles, up to 'max_interval' x 'eval_steps',
+    and it goes back to 'eval_steps' when the metric improves.
+    A checkpoint is saved only when the metric improves (the save steps are ignored).
+    """
+
+    def __init__(self, eval_steps, metric, greater_is_better=True, max_interval=8):
+        self.eval_steps = eval_steps
+        self.metric = metric if metric.startswith("eval_") else f"eval_{metric}"
+        self.is_better = operator.gt if greater_is_better else operator.lt
+        self.max_interval = max_interval
+
+        self.best = None
+        self.interval = 1
+        self.next_eval_step = eval_steps
+        self.nb_evaluations = 0
+
+    def on_step_end(self, args, state, control, **kwargs):
+        # replaces the 'every eval_steps' decision of the default flow
+        control.should_evaluate = state.global_step >= self.next_eval_step
+        control.should_save = False
+        return control
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        value = (metrics or {}).get(self.metric)
+        if value is None:
+            return control
+        self.nb_evaluations += 1
+
+        improved = self.best is None or self.is_better(value, self.best)
+        if improved:
+            self.best = value
+            self.interval = 1
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        control.should_save = improved
+        self.next_eval_step = state.global_step + self.interval * self.eval_steps
+        return control
@@ -0,0 +1,567 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: Copyright © <2022> Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Juan Zuluaga-Gomez <jzuluaga@idiap.ch>
+#
+# SPDX-License-Identifier: MIT-License
+
+"""
+    Batched inference engine for a text-based diarization model (BERT fine-tuned
+    for token classification). It replaces the HuggingFace 'token-classification'
+    pipeline used before:
+        1. the words are tokenized already split (is_split_into_words=True)
+        2. each batch is padded only to its own longest sequence
+        3. the forward pass runs under torch.inference_mode()
+        4. the subword scores are reduced to word scores (first, average or max)
+           and converted to word-level B-/I- tag ids for the whole batch at once
+
+    Long utterances can be split in overlapping windows of words ('window_size'),
+    instead of being truncated. The windows of all the utterances of a batch go
+    through the same forward pass, and the word scores in the overlaps are averaged.
+
+    The tags are kept as integer ids, and only mapped to strings when writing them.
+
+    With a model trained with early exits (see diarization_models.py) and an
+    'exit_threshold', each batch stops at the first exit where all its tokens
+    are predicted with a probability >= exit_threshold.
+"""
+
+import json
+import mmap
+import os
+import time
+
+import numpy as np
+import torch
+from transformers import AutoConfig, BertForTokenClassification, BertTokenizerFast
+from transformers.modeling_outputs import TokenClassifierOutput
+from transformers.modeling_utils import no_init_weights
+
+from diarization_models import BertForEarlyExitTokenClassification
+from diarization_pipeline import run_pipeline
+
+# name of the ONNX graph exported with export_onnx.py, stored next to the model
+ONNX_MODEL_NAME = "model.onnx"
+
+# weights in safetensors format (see convert_to_safetensors.py), they are memory-mapped
+SAFETENSORS_NAME = "model.safetensors"
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+class LogitsOnly(torch.nn.Module):
+    """Wrapper that returns only the logits of the model (no ModelOutput), to export or trace it"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        return self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+        ).logits
+
+
+class OnnxTokenClassifier:
+    """\
+    Token classification model exported to ONNX (see export_onnx.py), run with
+    an ONNX Runtime CPU session. It mimics the interface of the PyTorch model used
+    by DiarizationEngine: it has a 'config' and returns an object with 'logits'.
+    """
+
+    def __init__(self, path_to_model, num_threads=None):
+        import onnxruntime as ort
+
+        self.config = AutoConfig.from_pretrained(path_to_model)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+
+        self.session = ort.InferenceSession(
+            os.path.join(path_to_model, ONNX_MODEL_NAME),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_names = [graph_input.name for graph_input in self.session.get_inputs()]
+
+    def to(self, device):
+        if torch.device(device).type != "cpu":
+            raise ValueError("The onnxruntime backend only runs on CPU")
+        return self
+
+    def eval(self):
+        return self
+
+    def __call__(self, **inputs):
+        feed = {
+            name: inputs[name].cpu().numpy().astype(np.int64)
+            for name in self.input_names
+        }
+        logits = self.session.run(["logits"], feed)[0]
+        return TokenClassifierOutput(logits=torch.from_numpy(logits))
+
+
+def load_safetensors_mmap(path_to_file):
+    """Read a safetensors file as a state dict of tensors backed by a memory map
+    of the file (copy-on-write): nothing is read until it is used, and the
+    processes that load the same model share the pages of the file.
+    """
+    with open(path_to_file, "rb") as rd:
+        buffer = mmap.mmap(rd.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    # 8 bytes with the size of the JSON header, the header, then the data
+    header_size = int.from_bytes(buffer[:8], "little")
+    header = json.loads(buffer[8 : 8 + header_size])
+    header.pop("__metadata__", None)
+
+    state_dict = {}
+    for name, info in header.items():
+        start, end = info["data_offsets"]
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        if end == start:
+            state_dict[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        state_dict[name] = torch.frombuffer(
+            buffer,
+            dtype=dtype,
+            offset=8 + header_size + start,
+            count=(end - start) // torch.empty(0, dtype=dtype).element_size(),
+        ).view(info["shape"])
+    return state_dict
+
+
+def load_model_mmap(model_class, path_to_model):
+    """Build the model without initializing its weights, and use the
+    memory-mapped tensors of its safetensors file as parameters
+    """
+    config = AutoConfig.from_pretrained(path_to_model)
+    with no_init_weights():
+        model = model_class(config)
+
+    state_dict = load_safetensors_mmap(os.path.join(path_to_model, SAFETENSORS_NAME))
+    parameters = dict(model.named_parameters())
+    missing = set(parameters) - set(state_dict)
+    if missing:
+        raise ValueError(f"Weights not found in {SAFETENSORS_NAME}: {sorted(missing)}")
+
+    for name, tensor in state_dict.items():
+        module_name, _, attribute = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if name in parameters:
+            module._parameters[attribute] = torch.nn.Parameter(
+                tensor, requires_grad=False
+            )
+        elif attribute in module._buffers:
+            module._buffers[attribute] = tensor
+    return model.eval()
+
+
+def load_token_classification_model(path_to_model, backend="pytorch"):
+    """Load the fine-tuned model with the given backend (pytorch, onnxruntime or torchscript).
+    With pytorch, the weights are memory-mapped if the model has a safetensors file.
+    """
+    if backend == "pytorch":
+        # models trained with exits on intermediate layers (--early-exit-layers)
+        model_class = BertForTokenClassification
+        if getattr(AutoConfig.from_pretrained(path_to_model), "early_exit_layers", None):
+            model_class = BertForEarlyExitTokenClassification
+
+        if os.path.isfile(os.path.join(path_to_model, SAFETENSORS_NAME)):
+            return load_model_mmap(model_class, path_to_model)
+        return model_class.from_pretrained(path_to_model)
+    elif backend == "onnxruntime":
+        return OnnxTokenClassifier(path_to_model)
+    elif backend == "torchscript":
+        from diarization_jit import TorchScriptTokenClassifier
+
+        return TorchScriptTokenClassifier(path_to_model)
+    raise ValueError(f"Unknown backend: {backend}")
+
+
+def load_tokenizer(path_to_model):
+    """Load the tokenizer saved next to the model (tokenizer.save_pretrained),
+    the models trained before that use the one of bert-base-uncased
+    """
+    if os.path.isfile(os.path.join(path_to_model, "tokenizer.json")) or os.path.isfile(
+        os.path.join(path_to_model, "vocab.txt")
+    ):
+        return BertTokenizerFast.from_pretrained(path_to_model)
+    return BertTokenizerFast.from_pretrained("bert-base-uncased")
+
+
+class DiarizationEngine:
+    """\
+    Engine that performs batched inference with a BertForTokenClassification
+    model. It receives lists of words and returns one dictionary per utterance
+    with the words and the ids of their speaker-role tags:
+        {"text": [...], "tag_ids": np.ndarray}
+    """
+
+    # strategies to get the word scores from the subword scores
+    AGGREGATIONS = ("first", "average", "max")
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        device=None,
+        max_length=512,
+        aggregation="average",
+        window_size=0,
+        window_stride=None,
+        exit_threshold=None,
+    ):
+        if device is None:
+            device = (
+                "cuda"
+                if torch.cuda.is_available() and isinstance(model, torch.nn.Module)
+                else "cpu"
+            )
+
+        self.device = torch.device(device)
+        self.model = model.to(self.device).eval()
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        # number of subwords of each word seen, see subword_lengths
+        self.word_lengths = {}
+
+        if aggregation not in self.AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation strategy: {aggregation}")
+        self.aggregation = aggregation
+
+        # windows of words, 0 means no windows (the utterances are truncated to 'max_length')
+        self.window_size = window_size
+        self.window_stride = window_stride if window_stride else max(1, window_size // 2)
+        if window_size > 0 and not 0 < self.window_stride <= window_size:
+            raise ValueError("The window stride must be in [1, window_size]")
+
+        # adaptive depth, the number of layers used is accumulated to report the average
+        self.exit_threshold = exit_threshold
+        self.special_ids = torch.tensor(tokenizer.all_special_ids)
+        self.reset_depth_stats()
+
+        # labels of the model, e.g., B-atco, I-pilot, O
+        self.id2tag = {int(k): v for k, v in model.config.id2label.items()}
+        self.tag_names = np.array([self.id2tag[i] for i in range(len(self.id2tag))])
+        self._build_bio_tables()
+
+    def _build_bio_tables(self):
+        """Lookup tables to fix the BIO scheme with integer tag ids:
+        the entity of each tag (-1 for 'O'), and the B-/I- tag id of each entity
+        """
+        entities = sorted(
+            set(tag.split("-", 1)[1] for tag in self.tag_names if tag != "O")
+        )
+        tag2id = {tag: i for i, tag in enumerate(self.tag_names)}
+
+        self.tag_entity = torch.tensor(
+            [-1 if tag == "O" else entities.index(tag.split("-", 1)[1]) for tag in self.tag_names]
+        )
+        self.tag_is_begin = torch.tensor([tag.startswith("B-") for tag in self.tag_names])
+        self.entity_begin = torch.tensor(
+            [tag2id.get("B-" + e, tag2id.get("I-" + e)) for e in entities]
+        )
+        self.entity_inside = torch.tensor(
+            [tag2id.get("I-" + e, tag2id.get("B-" + e)) for e in entities]
+        )
+
+    @classmethod
+    def from_pretrained(cls, path_to_model, backend="pytorch", **kwargs):
+        """Load the fine-tuned model and the tokenizer and build the engine.
+        The loading times are kept in 'startup_times' (seconds)
+        """
+        start = time.perf_counter()
+        tokenizer = load_tokenizer(path_to_model)
+        tokenizer_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        model = load_token_classification_model(path_to_model, backend=backend)
+        engine = cls(model, tokenizer, **kwargs)
+        engine.startup_times = {
+            "tokenizer": tokenizer_time,
+            "weights": time.perf_counter() - start,
+        }
+        return engine
+
+    def tokenize(self, batch_words):
+        """Tokenize a batch of pre-split utterances, padded to its longest sample"""
+        return self.tokenizer(
+            batch_words,
+            is_split_into_words=True,
+            padding="longest",
+            truncation=True,
+            max_length=self.max_length,
+            return_tensors="pt",
+        )
+
+    def subword_lengths(self, batch_words):
+        """Number of subwords (with special tokens) of each pre-split utterance.
+        The words are tokenized one by one (WordPiece splits each word on its own),
+        and only the first time they are seen: no full tokenization of the batch
+        """
+        new_words = list(
+            {word for words in batch_words for word in words} - self.word_lengths.keys()
+        )
+        if len(new_words) > 0:
+            encodings = self.tokenizer(new_words, add_special_tokens=False)
+            self.word_lengths.update(zip(new_words, map(len, encodings["input_ids"])))
+
+        nb_special = self.tokenizer.num_special_tokens_to_add()
+        lengths = [
+            sum(self.word_lengths[word] for word in words) + nb_special
+            for words in batch_words
+        ]
+        return [min(length, self.max_length) for length in lengths]
+
+    def sequence_shapes(self, batch_words):
+        """Number of subwords of the longest sequence of each pre-split utterance,
+        and its number of sequences: one, or its windows if 'window_size' > 0
+        """
+        if self.window_size <= 0:
+            return self.subword_lengths(batch_words), [1] * len(batch_words)
+
+        window_words, utt_index, _ = self.split_windows(batch_words)
+        window_lengths = torch.tensor(self.subword_lengths(window_words))
+        lengths = torch.zeros(len(batch_words), dtype=torch.long).scatter_reduce(
+            0, utt_index, window_lengths, reduce="amax"
+        )
+        sizes = torch.bincount(utt_index, minlength=len(batch_words))
+        return lengths.tolist(), sizes.tolist()
+
+    def split_windows(self, batch_words):
+        """Split the utterances longer than 'window_size' words in overlapping windows.
+        Returns the words of each window, the index of its utterance and its first word.
+        The last window of an utterance is aligned to its end.
+        """
+        window_words, utt_index, starts = [], [], []
+        for idx, words in enumerate(batch_words):
+            last = max(len(words) - self.window_size, 0)
+            for start in list(range(0, last, self.window_stride)) + [last]:
+                window_words.append(words[start : start + self.window_size])
+                utt_index.append(idx)
+                starts.append(start)
+        return window_words, torch.tensor(utt_index), torch.tensor(starts)
+
+    def stitch_windows(self, word_scores, nb_words, utt_index, starts, nb_utts):
+        """Merge the word scores of the windows (W, C) into the word scores of the
+        utterances, the scores of the words seen by several windows are averaged.
+        Returns the scores and the number of words of each utterance.
+        """
+        ends = starts + nb_words
+        utt_words = torch.zeros(nb_utts, dtype=torch.long).scatter_reduce(
+            0, utt_index, ends, reduce="amax"
+        )
+        utt_offsets = torch.cumsum(utt_words, dim=0) - utt_words
+
+        # position of each window word in the words of the batch
+        window_offsets = torch.cumsum(nb_words, dim=0) - nb_words
+        position = torch.arange(int(nb_words.sum())) + torch.repeat_interleave(
+            utt_offsets[utt_index] + starts - window_offsets, nb_words
+        )
+
+        scores = torch.zeros(int(utt_words.sum()), word_scores.shape[-1])
+        scores.index_add_(0, position, word_scores)
+        counts = torch.zeros(int(utt_words.sum())).index_add_(
+            0, position, torch.ones(len(position))
+        )
+        return scores / counts.clamp(min=1)[:, None], utt_words
+
+    def forward(self, encodings):
+        """Run the forward pass of the model, returns the logits (B, L, C)"""
+        inputs = {key: val.to(self.device) for key, val in encodings.items()}
+        with torch.inference_mode():
+            if self.exit_threshold is not None:
+                return self.forward_early_exit(inputs)
+            logits = self.model(**inputs).logits
+        return logits
+
+    def forward_early_exit(self, inputs):
+        """Forward pass that stops at the first confident exit (all the subwords)"""
+        token_mask = inputs["attention_mask"].bool() & ~torch.isin(
+            inputs["input_ids"], self.special_ids.to(self.device)
+        )
+        logits, depth = self.model.forward_early_exit(
+            inputs["input_ids"],
+            inputs["attention_mask"],
+            inputs.get("token_type_ids"),
+            token_mask,
+            self.exit_threshold,
+        )
+        self.depth_sum += depth * logits.shape[0]
+        self.depth_samples += logits.shape[0]
+        return logits
+
+    @property
+    def exit_threshold(self):
+        return self._exit_threshold
+
+    @exit_threshold.setter
+    def exit_threshold(self, threshold):
+        if threshold is not None and not hasattr(self.model, "forward_early_exit"):
+            raise ValueError(
+                "The model has no early exits, train it with --early-exit-layers"
+            )
+        self._exit_threshold = threshold
+
+    def reset_depth_stats(self):
+        self.depth_sum, self.depth_samples = 0, 0
+
+    def add_depth_stats(self, depth_sum, depth_samples):
+        """Add the depth statistics of another engine (e.g., of a worker process)"""
+        self.depth_sum += depth_sum
+        self.depth_samples += depth_samples
+
+    def average_depth(self):
+        """Average number of layers used per utterance (early exit)"""
+        return self.depth_sum / max(self.depth_samples, 1)
+
+    def predict_logits(self, dataset, batch_size=32, prefetch=0):
+        """Run the forward pass on an already encoded dataset (ATCDataset_diarization).
+        Returns the logits and the labels as numpy arrays, like Trainer.predict().
+        If prefetch > 0, the batches are collated in a producer thread (see run_pipeline)
+        """
+        dataloader = torch.utils.data.DataLoader(
+            dataset, batch_size=batch_size, shuffle=False
+        )
+
+        raw_pred, raw_labels = [], []
+
+        def forward(batch):
+            labels = batch.pop("labels")
+            return self.forward(batch), labels
+
+        def consume(outputs):
+            raw_pred.append(outputs[0].float().cpu().numpy())
+            raw_labels.append(outputs[1].numpy())
+
+        if prefetch > 0:
+            stats = run_pipeline(
+                iter(dataloader), lambda batch: batch, forward, consume, prefetch
+            )
+            print("\n".join(map(str, stats)))
+        else:
+            for batch in dataloader:
+                consume(forward(batch))
+        return np.concatenate(raw_pred), np.concatenate(raw_labels)
+
+    def word_ids(self, encodings):
+        """Index of the word of each subword (B, L), special tokens are -1"""
+        return torch.tensor(
+            [
+                [-1 if w is None else w for w in encodings.word_ids(i)]
+                for i in range(encodings["input_ids"].shape[0])
+            ]
+        )
+
+    def word_scores(self, logits, word_ids):
+        """Reduce the subword scores (B, L, C) to word scores (W, C), with W the
+        number of words in the batch. The words of all the utterances are
+        concatenated, 'nb_words' holds the number of words per utterance.
+        """
+        scores = logits.float().cpu().softmax(dim=-1)
+
+        # words that survived the truncation, per utterance
+        nb_words = (word_ids.max(dim=1).values + 1).clamp(min=0)
+        offsets = torch.cumsum(nb_words, dim=0) - nb_words
+
+        valid = word_ids != -1
+        index = (word_ids + offsets[:, None])[valid]
+        scores = scores[valid]
+
+        if self.aggregation == "first":
+            # a word starts where the word index changes
+            is_first = torch.ones_like(index, dtype=torch.bool)
+            is_first[1:] = index[1:] != index[:-1]
+            return scores[is_first], nb_words
+
+        reduce = "mean" if self.aggregation == "average" else "amax"
+        word_scores = torch.zeros(int(nb_words.sum()), scores.shape[-1])
+        word_scores.scatter_reduce_(
+            0,
+            index[:, None].expand(-1, scores.shape[-1]),
+            scores,
+            reduce=reduce,
+            include_self=False,
+        )
+        return word_scores, nb_words
+
+    def fix_bio_ids(self, tag_ids, nb_words):
+        """Make the tag ids follow the BIO scheme: the first word of each speaker
+        segment gets the 'B-' tag and the following ones the 'I-' tag. This matches
+        the grouping done before by the HuggingFace pipeline.
+        """
+        entity = self.tag_entity[tag_ids]
+
+        # entity of the previous word, an utterance starts like after an 'O'
+        previous = torch.full_like(entity, -1)
+        previous[1:] = entity[:-1]
+        starts = torch.cumsum(nb_words, dim=0) - nb_words
+        previous[starts[nb_words > 0]] = -1
+
+        is_begin = self.tag_is_begin[tag_ids] | (entity != previous)
+        entity = entity.clamp(min=0)
+        fixed = torch.where(
+            is_begin, self.entity_begin[entity], self.entity_inside[entity]
+        )
+        return torch.where(self.tag_entity[tag_ids] == -1, tag_ids, fixed)
+
+    def decode(self, logits, encodings, batch_words, windows=None):
+        """Convert the logits of one batch to word-level B-/I- tag ids.
+        'windows' is the utterance index and first word of each window (see split_windows)
+        """
+        word_scores, nb_words = self.word_scores(logits, self.word_ids(encodings))
+        if windows is not None:
+            word_scores, nb_words = self.stitch_windows(
+                word_scores, nb_words, *windows, len(batch_words)
+            )
+        tag_ids = self.fix_bio_ids(word_scores.argmax(dim=-1), nb_words)
+
+        outputs = []
+        for words, ids in zip(batch_words, tag_ids.split(nb_words.tolist())):
+            outputs.append({"text": words[: len(ids)], "tag_ids": ids.numpy()})
+        return outputs
+
+    def format_tags(self, tag_ids):
+        """Map the tag ids to the tags string of the utt2text_tags format"""
+        return ",".join(self.tag_names[tag_ids])
+
+    # the three stages of 'predict', they can run in different threads (see diarization_pipeline.py)
+    def prepare(self, batch_words):
+        if self.window_size <= 0:
+            return {"words": batch_words, "encodings": self.tokenize(batch_words)}
+
+        window_words, utt_index, starts = self.split_windows(batch_words)
+        return {
+            "words": batch_words,
+            "encodings": self.tokenize(window_words),
+            "windows": (utt_index, starts),
+        }
+
+    def run(self, state):
+        state["logits"] = self.forward(state["encodings"])
+        return state
+
+    def finish(self, state):
+        return self.decode(
+            state["logits"], state["encodings"], state["words"], state.get("windows")
+        )
+
+    def predict(self, batch_words):
+        """Tag one batch of utterances, each utterance is a list of words"""
+        return self.finish(self.run(self.prepare(batch_words)))
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: Copyright © <2022> Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Juan Zuluaga-Gomez <jzuluaga@idiap.ch>
+#
+# SPDX-License-Identifier: MIT-License
+
+"""
+    TorchScript execution of a text-based diarization model (CPU). The forward
+    pass is traced once, frozen and stored on disk, next to the model:
+        <model>/torchscript/<fingerprint>.pt
+    The fingerprint includes the float weights, the config and the torch version
+    (see weights_fingerprint), so the next processes only load the traced graph
+    (no tracing), also after exporting or quantizing the model.
+
+    The inputs are padded to a fixed set of (batch, sequence length) buckets, up
+    to the maximum length of the model (512 subwords). Each bucket is warmed up
+    the first time a batch hits it (or all of them at start-up, 'warmup_at_start'),
+    so the batches only run shapes for which the TorchScript executor has already
+    optimized the graph. The long batches are split so that a bucket has at most
+    MAX_BUCKET_TOKENS tokens, which bounds the warm-up time.
+
+    The traced graph is the one of BertForTokenClassification: the models trained
+    with early exits run all their layers, the exit heads are not used.
+"""
+
+import os
+import time
+
+import torch
+from transformers import AutoConfig, BertForTokenClassification
+from transformers.modeling_outputs import TokenClassifierOutput
+
+from diarization_cache import weights_fingerprint
+from diarization_engine import LogitsOnly
+
+# shapes of the warm-up, the inputs are padded to the smallest bucket that fits them
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32)
+LENGTH_BUCKETS = (16, 32, 64, 128, 256, 512)
+# maximum batch x length of a bucket (e.g., 32 x 128 or 8 x 512)
+MAX_BUCKET_TOKENS = 4096
+
+# folder (in the model folder) where the traced graphs are stored
+TORCHSCRIPT_FOLDER = "torchscript"
+
+
+def _bucket(size, buckets):
+    """Smallest bucket that fits 'size', None if it does not fit in any"""
+    for bucket in buckets:
+        if size <= bucket:
+            return bucket
+    return None
+
+
+def trace_model(model, atol=1e-4, check_lengths=LENGTH_BUCKETS):
+    """Trace and freeze the logits of a BertForTokenClassification model.
+    The traced graph is checked against the eager model for several sequence
+    lengths, it must not be specialized to the shape used for tracing.
+    """
+    vocab_size = model.config.vocab_size
+    model = LogitsOnly(model).eval()
+    with torch.inference_mode():
+        inputs = _dummy_inputs(2, check_lengths[0])
+        traced = torch.jit.freeze(torch.jit.trace(model, inputs, check_trace=False))
+
+        for length in check_lengths:
+            inputs = _dummy_inputs(2, length, vocab_size)
+            max_diff = (traced(*inputs) - model(*inputs)).abs().max().item()
+            if max_diff > atol:
+                raise RuntimeError(
+                    f"The traced model differs from the eager model ({max_diff:.2e}) for length {length}"
+                )
+    return traced
+
+
+def _dummy_inputs(batch_size, length, vocab_size=None):
+    """Inputs to trace or warm up the model, random token ids if 'vocab_size' is given"""
+    if vocab_size is not None:
+        input_ids = torch.randint(0, vocab_size, (batch_size, length))
+    else:
+        input_ids = torch.ones(batch_size, length, dtype=torch.long)
+    return (
+        input_ids,
+        torch.ones(batch_size, length, dtype=torch.long),
+        torch.zeros(batch_size, length, dtype=torch.long),
+    )
+
+
+class TorchScriptTokenClassifier:
+    """\
+    Token classification model run with TorchScript, with inputs padded to
+    shape buckets. It mimics the interface of the PyTorch model used by
+    DiarizationEngine: it has a 'config' and returns an object with 'logits'.
+    """
+
+    def __init__(
+        self,
+        path_to_model,
+        batch_buckets=BATCH_BUCKETS,
+        length_buckets=LENGTH_BUCKETS,
+        max_bucket_tokens=MAX_BUCKET_TOKENS,
+        path_to_traced=None,
+        warmup_at_start=False,
+    ):
+        self.config = AutoConfig.from_pretrained(path_to_model)
+        self.batch_buckets = sorted(batch_buckets)
+        # the buckets longer than the position embeddings can not be run
+        self.length_buckets = sorted(
+            length
+            for length in length_buckets
+            if length <= self.config.max_position_embeddings
+        )
+        self.max_bucket_tokens = max_bucket_tokens
+        self.pad_token_id = self.config.pad_token_id or 0
+
+        # batches longer than the largest length bucket are run without padding
+        # (not warmed up), it does not happen with the default buckets
+        self.unbucketed = 0
+        self.warmed_up = set()
+
+        if path_to_traced is None:
+            fingerprint = weights_fingerprint(path_to_model, torch.__version__)
+            path_to_traced = os.path.join(
+                path_to_model, TORCHSCRIPT_FOLDER, f"{fingerprint[:16]}.pt"
+            )
+
+        start = time.perf_counter()
+        if os.path.isfile(path_to_traced):
+            self.traced = torch.jit.load(path_to_traced, map_location="cpu")
+            origin = "loaded from"
+        else:
+            if getattr(self.config, "early_exit_layers", None):
+                print("TorchScript: the early exits of the model are not traced")
+            model = BertForTokenClassification.from_pretrained(path_to_model)
+            self.traced = trace_model(model, check_lengths=self.length_buckets)
+            os.makedirs(os.path.dirname(path_to_traced), exist_ok=True)
+            torch.jit.save(self.traced, path_to_traced)
+            origin = "traced and saved in"
+        if warmup_at_start:
+            self.warmup()
+        print(
+            f"TorchScript model {origin}: {path_to_traced} "
+            f"in {time.perf_counter() - start:.1f} s ({len(self.shape_buckets())} shape "
+            f"buckets, warmed up {'at start-up' if warmup_at_start else 'at first use'})"
+        )
+
+    def max_batch(self, length):
+        """Largest batch bucket for a length bucket, within 'max_bucket_tokens'"""
+        batch_sizes = [
+            batch_size
+            for batch_size in self.batch_buckets
+            if batch_size * length <= self.max_bucket_tokens
+        ]
+        return batch_sizes[-1] if batch_sizes else self.batch_buckets[0]
+
+    def shape_buckets(self):
+        """(batch, length) shapes that the batches can hit"""
+        return [
+            (batch_size, length)
+            for length in self.length_buckets
+            for batch_size in self.batch_buckets
+            if batch_size <= self.max_batch(length)
+        ]
+
+    def warmup(self, shapes=None, nb_runs=2):
+        """Run the shape buckets (default: all), the executor optimizes the graph
+        after a few runs
+        """
+        with torch.inference_mode():
+            for batch_size, length in shapes or self.shape_buckets():
+                for _ in range(nb_runs):
+                    self.traced(*_dummy_inputs(batch_size, length))
+                self.warmed_up.add((batch_size, length))
+
+    def to(self, device):
+        if torch.device(device).type != "cpu":
+            raise ValueError("The torchscript backend only runs on CPU")
+        return self
+
+    def eval(self):
+        return self
+
+    def _pad(self, tensor, batch_size, length, value):
+        padded = tensor.new_full((batch_size, length), value)
+        padded[: tensor.shape[0], : tensor.shape[1]] = tensor
+        return padded
+
+    def _forward_bucket(self, input_ids, attention_mask, token_type_ids):
+        """Pad one batch to its bucket, run it and remove the padding of the logits"""
+        batch_size, length = input_ids.shape
+        bucket_batch = _bucket(batch_size, self.batch_buckets)
+        bucket_length = _bucket(length, self.length_buckets)
+        if bucket_length is None:
+            self.unbucketed += 1
+            bucket_length = length
+        elif (bucket_batch, bucket_length) not in self.warmed_up:
+            self.warmup([(bucket_batch, bucket_length)])
+
+        logits = self.traced(
+            self._pad(input_ids, bucket_batch, bucket_length, self.pad_token_id),
+            self._pad(attention_mask, bucket_batch, bucket_length, 0),
+            self._pad(token_type_ids, bucket_batch, bucket_length, 0),
+        )
+        return logits[:batch_size, :length]
+
+    def __call__(self, input_ids, attention_mask, token_type_ids=None):
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+
+        # batches larger than the largest bucket (for their length) are split
+        length = _bucket(input_ids.shape[1], self.length_buckets)
+        max_batch = self.max_batch(length or input_ids.shape[1])
+        with torch.inference_mode():
+            logits = [
+                self._forward_bucket(
+                    input_ids[start : start + max_batch],
+                    attention_mask[start : start + max_batch],
+                    token_type_ids[start : start + max_batch],
+                )
+                for start in range(0, input_ids.shape[0], max_batch)
+            ]
+        return TokenClassifierOutput(logits=torch.cat(logits))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: Copyright © <2022> Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Juan Zuluaga-Gomez <jzuluaga@idiap.ch>
+#
+# SPDX-License-Identifier: MIT-License
+
+"""
+    Metrics of text-based diarization computed on the tag ids, without
+    converting them to strings. The predictions and labels are added batch by
+    batch and the metric only keeps counts:
+        - a confusion matrix of the word tags: accuracy and JER (weighted Jaccard
+          error rate, same as compute_jer in diarization_utils.py)
+        - the number of predicted, true and correct entity spans (speaker turns):
+          precision, recall and F1, with the same span rules as seqeval (IOB2)
+"""
+
+import numpy as np
+
+
+class DiarizationMetrics:
+    """\
+    Streaming metrics on the tag ids. 'id2tag' maps the ids to the tags
+    (e.g., B-atco, I-pilot, O). Call update() with the predictions (ids, or
+    logits with the tags in the last dimension) and labels of each batch, where
+    the labels are -100 for the subwords that are not scored, then compute().
+    """
+
+    def __init__(self, id2tag):
+        id2tag = {int(k): v for k, v in id2tag.items()}
+        self.num_labels = max(id2tag) + 1
+
+        # entity type of each tag (-1 for O), and whether it starts a span
+        types = sorted({tag.split("-", 1)[-1] for tag in id2tag.values() if tag != "O"})
+        self.tag_type = np.full(self.num_labels, -1, dtype=np.int64)
+        self.tag_begin = np.zeros(self.num_labels, dtype=bool)
+        for idx, tag in id2tag.items():
+            if tag != "O":
+                self.tag_type[idx] = types.index(tag.split("-", 1)[-1])
+                self.tag_begin[idx] = tag.startswith("B-")
+        self.num_types = max(len(types), 1)
+        self.reset()
+
+    def reset(self):
+        self.confusion = np.zeros((self.num_labels, self.num_labels), dtype=np.int64)
+        self.nb_pred_spans = 0
+        self.nb_true_spans = 0
+        self.nb_correct_spans = 0
+
+    def spans(self, tags, line_starts):
+        """Keys (start, end, type) of the spans of a flat sequence of tag ids,
+        the spans do not cross the lines (line_starts marks the first word of each line)
+        """
+        types = self.tag_type[tags]
+        previous = np.concatenate([[-1], types[:-1]])
+        starts = (types != -1) & (self.tag_begin[tags] | line_starts | (previous != types))
+        # a span ends where the next span starts, or at the next O / line start
+        boundaries = starts | (types == -1) | line_starts
+        boundaries = np.append(np.flatnonzero(boundaries), len(tags))
+
+        span_starts = np.flatnonzero(starts)
+        span_ends = boundaries[np.searchsorted(boundaries, span_starts, side="right")]
+        return (span_starts * (len(tags) + 1) + span_ends) * self.num_types + types[
+            span_starts
+        ]
+
+    def update(self, predictions, labels):
+        """Add a batch of predictions (B, L) or logits (B, L, C) and labels (B, L)"""
+        predictions, labels = np.asarray(predictions), np.asarray(labels)
+        if predictions.ndim == labels.ndim + 1:
+            predictions = predictions.argmax(axis=-1)
+
+        # words (first subwords) of the batch, in order
+        mask = labels != -100
+        true_tags, pred_tags = labels[mask], predictions[mask]
+        line_starts = np.zeros(len(true_tags), dtype=bool)
+        nb_words = mask.sum(axis=1)
+        line_starts[(np.cumsum(nb_words) - nb_words)[nb_words > 0]] = True
+
+        self.confusion += np.bincount(
+            true_tags * self.num_labels + pred_tags, minlength=self.num_labels**2
+        ).reshape(self.num_labels, self.num_labels)
+
+        true_spans = self.spans(true_tags, line_starts)
+        pred_spans = self.spans(pred_tags, line_starts)
+        self.nb_true_spans += len(true_spans)
+        self.nb_pred_spans += len(pred_spans)
+        self.nb_correct_spans += len(np.intersect1d(true_spans, pred_spans))
+
+    def compute(self):
+        """Precision, recall, F1 (spans), accuracy and JER (%) (word tags)"""
+        precision = self.nb_correct_spans / max(self.nb_pred_spans, 1)
+        recall = self.nb_correct_spans / max(self.nb_true_spans, 1)
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+
+        total = self.confusion.sum()
+        accuracy = np.trace(self.confusion) / max(total, 1)
+
+        # weighted Jaccard index of the tags, weights: number of true words per tag
+        correct = np.diag(self.confusion)
+        union = self.confusion.sum(axis=0) + self.confusion.sum(axis=1) - correct
+        jaccard = np.divide(correct, union, out=np.zeros(len(union)), where=union > 0)
+        support = self.confusion.sum(axis=1)
+        jer = (1 - (jaccard * support).sum() / max(support.sum(), 1)) * 100
+
+        return {
+            "precision": float(precision),
+            "recall": float(recall),
+            "f1": float(f1),
+            "accuracy": float(accuracy),
+            "jer": float(jer),
+        }
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: Copyright © <2022> Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Juan Zuluaga-Gomez <jzuluaga@idiap.ch>
+#
+# SPDX-License-Identifier: MIT-License
+
+"""
+    Token classification models for text-based diarization.
+
+    BertForEarlyExitTokenClassification adds light classification heads on some
+    intermediate layers of BERT ('early_exit_layers' in the config). They are
+    trained together with the final classifier, and at inference a batch can
+    stop at the first exit where the model is confident enough for all its tokens
+    (adaptive depth): easy utterances do not need all the layers.
+"""
+
+from torch import nn
+from transformers import BertForTokenClassification
+from transformers.modeling_outputs import TokenClassifierOutput
+
+
+class BertForEarlyExitTokenClassification(BertForTokenClassification):
+    """\
+    BertForTokenClassification with extra classification heads (exits) after the
+    layers listed in 'config.early_exit_layers' (1-based, e.g., [4, 8]).
+    The training loss is the average of the cross-entropy of all the heads.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.early_exit_layers = sorted(getattr(config, "early_exit_layers", []))
+        self.exit_classifiers = nn.ModuleList(
+            [
+                nn.Linear(config.hidden_size, config.num_labels)
+                for _ in self.early_exit_layers
+            ]
+        )
+        self.post_init()
+
+    def forward(
+        self,
+        input_ids=None,
+        attention_mask=None,
+        token_type_ids=None,
+        labels=None,
+        **kwargs,
+    ):
+        # the hidden states are always needed for the exits, but only returned
+        # when asked (the Trainer would gather them as predictions otherwise)
+        output_hidden_states = kwargs.pop("output_hidden_states", None)
+        kwargs.pop("return_dict", None)
+        outputs = self.bert(
+            input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+            output_hidden_states=True,
+            return_dict=True,
+            **kwargs,
+        )
+        logits = self.classifier(self.dropout(outputs.last_hidden_state))
+
+        loss = None
+        if labels is not None:
+            # hidden_states[0] is the output of the embeddings
+            all_logits = [
+                head(self.dropout(outputs.hidden_states[layer]))
+                for layer, head in zip(self.early_exit_layers, self.exit_classifiers)
+            ] + [logits]
+            loss_fct = nn.CrossEntropyLoss()
+            loss = sum(
+                loss_fct(head_logits.view(-1, self.num_labels), labels.view(-1))
+                for head_logits in all_logits
+            ) / len(all_logits)
+
+        return TokenClassifierOutput(
+            loss=loss,
+            logits=logits,
+            hidden_states=outputs.hidden_states if output_hidden_states else None,
+            attentions=outputs.attentions,
+        )
+
+    def forward_early_exit(
+        self, input_ids, attention_mask, token_type_ids, token_mask, threshold
+    ):
+        """Run the layers one by one, and stop at the first exit where the maximum
+        probability of all the tokens in 'token_mask' is >= threshold.
+        Returns the logits and the number of layers used.
+        """
+        hidden = self.bert.embeddings(input_ids=input_ids, token_type_ids=token_type_ids)
+        extended_mask = self.get_extended_attention_mask(attention_mask, input_ids.shape)
+        exits = dict(zip(self.early_exit_layers, self.exit_classifiers))
+
+        for depth, layer in enumerate(self.bert.encoder.layer, start=1):
+            hidden = layer(hidden, attention_mask=extended_mask)[0]
+            if depth in exits and depth < len(self.bert.encoder.layer):
+                logits = exits[depth](hidden)
+                confidence = logits.softmax(dim=-1).max(dim=-1).values
+                if bool((confidence[token_mask] >= threshold).all()):
+                    return logits, depth
+
+        return self.classifier(hidden), len(self.bert.encoder.layer)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: Copyright © <2022> Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Juan Zuluaga-Gomez <jzuluaga@idiap.ch>
+#
+# SPDX-License-Identifier: MIT-License
+
+"""
+    Producer/consumer pipeline to overlap the stages of inference:
+        1. prepare thread: tokenization and padding (the fast tokenizer releases the GIL)
+        2. main thread: forward pass of the model
+        3. writer thread: decoding and formatting of the outputs
+    The stages communicate with bounded queues, so the model does not wait
+    for Python to build strings, and the memory used by prefetched batches is bounded.
+"""
+
+import queue
+import threading
+import time
+
+# marks the end of the stream in the queues
+_END = object()
+
+
+class StageStats:
+    """Time spent working and waiting (on the queues) by one stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.wait = 0.0
+        self.items = 0
+
+    def __str__(self):
+        return f"{self.name:>8}: busy {self.busy:8.3f} s | waiting {self.wait:8.3f} s | {self.items} batches"
+
+
+def _timed_put(q, item, stats):
+    start = time.perf_counter()
+    q.put(item)
+    stats.wait += time.perf_counter() - start
+
+
+def _timed_get(q, stats):
+    start = time.perf_counter()
+    item = q.get()
+    stats.wait += time.perf_counter() - start
+    return item
+
+
+def run_pipeline(batches, prepare_fn, forward_fn, consume_fn, queue_size=4):
+    """Run 'consume_fn(forward_fn(prepare_fn(batch)))' for each batch, with the three
+    stages overlapped in different threads. Returns the statistics of each stage,
+    the bottleneck is the stage that is busy most of the time.
+    """
+
+    prepared, forwarded = queue.Queue(queue_size), queue.Queue(queue_size)
+    stats = [StageStats("prepare"), StageStats("forward"), StageStats("write")]
+    errors = []
+
+    def producer():
+        try:
+            iterator = iter(batches)
+            while not errors:
+                # getting the next batch (e.g., collating it) is part of the stage
+                start = time.perf_counter()
+                batch = next(iterator, _END)
+                if batch is _END:
+                    break
+                item = prepare_fn(batch)
+                stats[0].busy += time.perf_counter() - start
+                stats[0].items += 1
+                _timed_put(prepared, item, stats[0])
+        except Exception as e:
+            errors.append(e)
+        finally:
+            prepared.put(_END)
+
+    def writer():
+        while True:
+            item = _timed_get(forwarded, stats[2])
+            if item is _END:
+                break
+            if errors:
+                continue  # drain the queue, the error is raised in the main thread
+            try:
+                start = time.perf_counter()
+                consume_fn(item)
+                stats[2].busy += time.perf_counter() - start
+                stats[2].items += 1
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=producer), threading.Thread(target=writer)]
+    for thread in threads:
+        thread.start()
+
+    # the forward pass runs in the calling thread
+    while True:
+        item = _timed_get(prepared, stats[1])
+        if item is _END:
+            break
+        if errors:
+            continue  # drain the queue, the error is raised below
+        try:
+            start = time.perf_counter()
+            output = forward_fn(item)
+            stats[1].busy += time.perf_counter() - start
+            stats[1].items += 1
+            _timed_put(forwarded, output, stats[1])
+        except Exception as e:
+            errors.append(e)
+
+    forwarded.put(_END)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return stats
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: Copyright © <2022> Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Juan Zuluaga-Gomez <jzuluaga@idiap.ch>
+#
+# SPDX-License-Identifier: MIT-License
+
+"""
+    Dynamic int8 quantization of a text-based diarization model. The Linear
+    layers of the BERT token classification model are quantized to int8 (CPU only).
+
+    Before accepting a quantized model, its JER is compared with the one of the
+    float model on a held-out utt2text_tags file (guardrail). The accepted model
+    is saved with a fingerprint of the float model, so the next runs load it
+    (without loading the float model) instead of quantizing it again, until the
+    float model changes (e.g., retrained).
+"""
+
+import copy
+import os
+import time
+
+import torch
+from transformers import AutoConfig, BertForTokenClassification
+
+from diarization_cache import weights_fingerprint
+from diarization_engine import DiarizationEngine, load_tokenizer
+from diarization_models import BertForEarlyExitTokenClassification
+from diarization_utils import compute_jer, compute_metrics, load_diarization_dataset
+
+# name of the quantized model, stored next to the float model by default
+QUANTIZED_MODEL_NAME = "quantized_int8.pt"
+
+
+def quantize_int8(model):
+    """Apply dynamic int8 quantization to the Linear layers of a copy of the model"""
+    return torch.quantization.quantize_dynamic(
+        copy.deepcopy(model).cpu().eval(), {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def load_quantized_model(path_to_model, checkpoint):
+    """Load a quantized model saved by 'quantize_engine' (the loaded checkpoint).
+    The float weights are not loaded, the model is built from its config and
+    quantized before loading the int8 state_dict.
+    """
+    config = AutoConfig.from_pretrained(path_to_model)
+    # models trained with exits on intermediate layers (--early-exit-layers)
+    model_class = BertForTokenClassification
+    if getattr(config, "early_exit_layers", None):
+        model_class = BertForEarlyExitTokenClassification
+    model = quantize_int8(model_class(config))
+    model.load_state_dict(checkpoint["state_dict"])
+    return model, checkpoint["guardrail"]
+
+
+def compute_guard_jer(engine, guard_data, batch_size=32):
+    """Compute the JER of the model of 'engine' on the guard data"""
+    tag2id = engine.model.config.label2id
+    dataset = load_diarization_dataset(guard_data, engine.tokenizer, tag2id)
+
+    raw_pred, raw_labels = engine.predict_logits(dataset, batch_size=batch_size)
+    compute_metrics(raw_pred, raw_labels, label_list=engine.id2tag)
+    return compute_jer(raw_pred, raw_labels, label_list=engine.id2tag)
+
+
+def get_quantized_path(path_to_model, path_to_quantized=None):
+    """Path of the int8 model, next to the float model by default"""
+    if path_to_quantized is None:
+        return os.path.join(path_to_model, QUANTIZED_MODEL_NAME)
+    return path_to_quantized
+
+
+def load_quantized_engine(path_to_model, path_to_quantized=None, **kwargs):
+    """Get an engine with the int8 model saved by 'quantize_engine', without
+    loading the float model. 'kwargs' are the options of DiarizationEngine.
+    Returns None if there is no int8 model of the current float model (not
+    quantized yet, or quantized from another one, e.g., before retraining it).
+    """
+    path_to_quantized = get_quantized_path(path_to_model, path_to_quantized)
+    if not os.path.isfile(path_to_quantized):
+        return None
+
+    start = time.perf_counter()
+    checkpoint = torch.load(path_to_quantized, map_location="cpu")
+    if checkpoint.get("fingerprint") != weights_fingerprint(path_to_model):
+        print(
+            f"The int8 model in: {path_to_quantized} was quantized from another "
+            f"float model, quantizing it again"
+        )
+        return None
+    model, guardrail = load_quantized_model(path_to_model, checkpoint)
+    weights_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tokenizer = load_tokenizer(path_to_model)
+    tokenizer_time = time.perf_counter() - start
+
+    print(
+        f"Loaded the int8 model from: {path_to_quantized} "
+        f"(JER float: {guardrail['jer_float']:.2f}, JER int8: {guardrail['jer_int8']:.2f})"
+    )
+    engine = DiarizationEngine(model, tokenizer, device="cpu", **kwargs)
+    engine.startup_times = {"tokenizer": tokenizer_time, "int8 weights": weights_time}
+    return engine
+
+
+def quantize_engine(
+    engine,
+    path_to_model,
+    guard_data=None,
+    max_jer_degradation=1.0,
+    path_to_quantized=None,
+    batch_size=32,
+):
+    """Get an engine with the int8 model of 'engine' (the float model is not modified).
+    The model is quantized and accepted only if its JER on 'guard_data' is not
+    worse than the JER of the float model plus 'max_jer_degradation' (absolute, in %).
+    The accepted model is saved with the fingerprint of the float model, see
+    'load_quantized_engine'.
+    """
+    path_to_quantized = get_quantized_path(path_to_model, path_to_quantized)
+    if guard_data is None:
+        raise ValueError(
+            "a held-out utt2text_tags file (--guard-data) is needed to accept a new int8 model"
+        )
+
+    print("Quantizing the Linear layers of the model to int8 (dynamic quantization)")
+    # same options as the float engine, only the effect of quantization is measured
+    int8_engine = DiarizationEngine(
+        quantize_int8(engine.model),
+        engine.tokenizer,
+        device="cpu",
+        aggregation=engine.aggregation,
+        window_size=engine.window_size,
+        window_stride=engine.window_stride,
+        exit_threshold=engine.exit_threshold,
+    )
+
+    # guardrail: compare the JER of the float and the int8 models
+    jer_float = compute_guard_jer(engine, guard_data, batch_size=batch_size)
+    jer_int8 = compute_guard_jer(int8_engine, guard_data, batch_size=batch_size)
+    print(f"JER float: {jer_float:.2f}, JER int8: {jer_int8:.2f} (on: {guard_data})")
+
+    if jer_int8 - jer_float > max_jer_degradation:
+        raise RuntimeError(
+            f"The int8 model degrades the JER by {jer_int8 - jer_float:.2f} "
+            f"(max. allowed: {max_jer_degradation}), refusing the quantized model"
+        )
+
+    guardrail = {
+        "guard_data": guard_data,
+        "jer_float": jer_float,
+        "jer_int8": jer_int8,
+    }
+    torch.save(
+        {
+            "state_dict": int8_engine.model.state_dict(),
+            "guardrail": guardrail,
+            "fingerprint": weights_fingerprint(path_to_model),
+        },
+        path_to_quantized,
+    )
+    print(f"Accepted the int8 model, saved in: {path_to_quantized}")
+    return int8_engine
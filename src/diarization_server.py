@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: Copyright © <2022> Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Juan Zuluaga-Gomez <jzuluaga@idiap.ch>
+#
+# SPDX-License-Identifier: MIT-License
+
+"""
+    Long-lived server for text-based diarization. The model and tokenizer are
+    loaded only once, and the utterances sent by concurrent clients are gathered
+    in micro-batches before running the forward pass:
+        - a batch is run when it has 'max_batch_size' utterances, or
+        - when the oldest utterance waited 'max_wait_ms' milliseconds
+
+    The protocol is one JSON object per line (over a Unix or TCP socket):
+        request:  {"id": "utt_id", "text": "lufthansa one two three climb flight level one zero zero"}
+        response: {"id": "utt_id", "text": [...], "tags": [...], "timing": {...}}
+"""
+
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+
+from diarization_utils import clean_input_utterance
+
+
+class MicroBatcher:
+    """\
+    Collect the requests coming from several threads and run them through the
+    engine in micro-batches. Each request gets a Future with its prediction.
+    """
+
+    def __init__(self, engine, max_batch_size=32, max_wait_ms=5.0):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.requests = queue.Queue()
+
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, words):
+        """Queue one utterance (list of words), returns a Future"""
+        future = Future()
+        self.requests.put((words, time.perf_counter(), future))
+        return future
+
+    def _next_batch(self):
+        """Block until one request arrives, then wait for more until the deadline"""
+        batch = [self.requests.get()]
+        deadline = batch[0][1] + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    batch.append(self.requests.get(timeout=timeout))
+                else:
+                    # take the requests that are already waiting, but do not block
+                    batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+
+            start = time.perf_counter()
+            try:
+                outputs = self.engine.predict([words for words, _, _ in batch])
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            end = time.perf_counter()
+
+            for (_, arrival, future), output in zip(batch, outputs):
+                timing = {
+                    "queue_ms": round((start - arrival) * 1000, 3),
+                    "forward_ms": round((end - start) * 1000, 3),
+                    "batch_size": len(batch),
+                }
+                future.set_result((output, timing))
+
+
+class DiarizationRequestHandler(socketserver.StreamRequestHandler):
+    """Read one JSON request per line and write one JSON response per line"""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+
+            arrival = time.perf_counter()
+            try:
+                request = json.loads(line)
+                response = {"id": request.get("id")}
+
+                words = clean_input_utterance(request["text"]).split()
+                if len(words) == 0:
+                    text, tags, timing = [], [], {}
+                else:
+                    output, timing = self.server.batcher.submit(words).result()
+                    text = output["text"]
+                    tags = self.server.batcher.engine.tag_names[output["tag_ids"]]
+
+                timing["total_ms"] = round((time.perf_counter() - arrival) * 1000, 3)
+                response.update({"text": text, "tags": list(tags), "timing": timing})
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+
+            self.wfile.write((json.dumps(response) + "\n").encode("utf8"))
+            self.wfile.flush()
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def parse_address(address):
+    """Get the socket family and address from 'unix:/path/to/socket' or 'host:port'"""
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:") :]
+    if "/" in address:
+        return socket.AF_UNIX, address
+
+    host, port = address.rsplit(":", 1)
+    return socket.AF_INET, (host, int(port))
+
+
+def serve(engine, address, max_batch_size=32, max_wait_ms=5.0):
+    """Start the diarization server, it runs until it is interrupted"""
+
+    family, server_address = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(server_address):
+            os.remove(server_address)
+        server = ThreadingUnixServer(server_address, DiarizationRequestHandler)
+    else:
+        server = ThreadingTCPServer(server_address, DiarizationRequestHandler)
+
+    # first forward pass before accepting requests (lazy initialization of torch)
+    engine.predict([["roger"]])
+
+    server.batcher = MicroBatcher(
+        engine, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms
+    )
+
+    print(
+        f"Serving text-based diarization on '{address}' "
+        f"(max batch size: {max_batch_size}, max wait: {max_wait_ms} ms)"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if family == socket.AF_UNIX and os.path.exists(server_address):
+            os.remove(server_address)
+
+
+def tag_utterances(address, texts):
+    """Small client: send the utterances to a running server and get the responses"""
+
+    family, server_address = parse_address(address)
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.connect(server_address)
+        with sock.makefile("rwb") as stream:
+            responses = []
+            for idx, text in enumerate(texts):
+                request = {"id": idx, "text": text}
+                stream.write((json.dumps(request) + "\n").encode("utf8"))
+                stream.flush()
+                responses.append(json.loads(stream.readline()))
+    return responses
@@ -19,53 +19,569 @@
 
 """
 
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import shutil
+import tempfile
+
 import numpy as np
 import torch
 from sklearn.metrics import classification_report, jaccard_score
 
 
+def flatten_columns(encodings, labels):
+    """Concatenate the samples of each key of the encodings (and the labels) in
+    one flat int32 array. Returns the arrays and the offsets (start of each sample)
+    """
+    nb_samples = len(labels)
+    lengths = [len(ids) for ids in encodings["input_ids"][:nb_samples]]
+    offsets = np.zeros(nb_samples + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    values = {key: encodings[key][:nb_samples] for key in encodings.keys()}
+    values["labels"] = labels
+    columns = {}
+    for key, samples in values.items():
+        if nb_samples > 0 and isinstance(samples[0], np.ndarray):
+            columns[key] = np.concatenate(samples).astype(np.int32)
+        else:
+            columns[key] = np.fromiter(
+                itertools.chain.from_iterable(samples),
+                dtype=np.int32,
+                count=offsets[-1],
+            )
+    return columns, offsets
+
+
 class ATCDataset_diarization(torch.utils.data.Dataset):
     """Standard dataset object used by PyTorch and Huggingface.
     We use it to load the data for training and fine-tuning.
+
+    The samples are stored by columns: for each key (input_ids, attention_mask,
+    labels...) one flat int32 tensor, and 'offsets' holds where each sample starts.
+    The items are views of these tensors (no copy, no Python objects per sample,
+    so the pages stay shared with forked DataLoader workers).
+
+    pad_to_longest: pad all the samples to the longest one (same as padding=True
+        in the tokenizer), the items are then int64 copies. Otherwise use a
+        DataCollatorForTokenClassification (it pads each batch)
+    pad_values: padding value of each key, labels are padded with -100, the rest with 0
     """
 
-    def __init__(self, encodings, labels):
-        self.encodings = encodings
-        self.labels = labels
+    def __init__(self, encodings, labels, pad_to_longest=False, pad_values=None):
+        columns, offsets = flatten_columns(encodings, labels)
+        self._columns = {key: torch.from_numpy(val) for key, val in columns.items()}
+        self.offsets = offsets
+        self.pad_values = {key: -100 if key == "labels" else 0 for key in columns}
+        self.pad_values.update(pad_values or {})
+        self.max_length = (
+            int(np.diff(self.offsets).max(initial=0)) if pad_to_longest else None
+        )
+
+    @property
+    def columns(self):
+        return self._columns
 
     def __getitem__(self, idx):
-        item = {key: torch.tensor(val[idx]) for key, val in self.encodings.items()}
-        item["labels"] = torch.tensor(self.labels[idx])
+        start, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        if self.max_length is None:
+            return {key: column[start:end] for key, column in self.columns.items()}
+
+        item = {}
+        for key, column in self.columns.items():
+            item[key] = torch.nn.functional.pad(
+                column[start:end].long(),
+                (0, self.max_length - (end - start)),
+                value=self.pad_values[key],
+            )
         return item
 
     def __len__(self):
-        return len(self.labels)
+        return len(self.offsets) - 1
 
 
-def encode_tags(tag2id, tags, encodings):
-    """Function to encode the tags in the format needed by the model.
-    This is due to using of subword units
-    """
+# default folder of the line indexes of LineIndexedFile, not next to the data
+# (the data folders can be read-only)
+LINE_INDEX_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "atc_diarization",
+    "line_index",
+)
+
 
-    labels = [[tag2id[tag] for tag in doc] for doc in tags]
-    encoded_labels = []
-    cnt = 0
-    for doc_labels, doc_offset in zip(labels, encodings.offset_mapping):
+class LineIndexedFile:
+    """Random access to the lines of a (huge) text file. The file is memory-mapped
+    and the byte offsets of the lines are computed once, then cached in 'index_dir'
+    (default: LINE_INDEX_DIR), keyed by the path of the file. The index is computed
+    again if the file is newer than it, and kept in memory if it can not be written.
+    """
 
-        # create an empty array of -100, not used during loss calculation
-        doc_enc_labels = np.ones(len(doc_offset), dtype=int) * -100
-        arr_offset = np.array(doc_offset)
+    def __init__(self, file_path, chunk_size=64 * 1024**2, index_dir=None):
+        self.file_path = file_path
+        self.index_dir = index_dir or LINE_INDEX_DIR
+        file_size = os.path.getsize(file_path)
+        self.offsets = self.cached_array(
+            "idx",
+            lambda: self._build_offsets(chunk_size),
+            is_valid=lambda offsets: len(offsets) > 0 and offsets[-1] == file_size,
+        )
+        self._mmap, self._mmap_pid = None, None
+
+    def cached_array(self, name, build, is_valid=None):
+        """Array computed from the file with 'build', stored in the index folder
+        as '<file name>.<hash of the path>.<name>.npy'
+        """
+        key = hashlib.sha1(os.path.abspath(self.file_path).encode()).hexdigest()[:16]
+        index_path = os.path.join(
+            self.index_dir, f"{os.path.basename(self.file_path)}.{key}.{name}.npy"
+        )
+        if os.path.isfile(index_path) and os.path.getmtime(
+            index_path
+        ) >= os.path.getmtime(self.file_path):
+            array = np.load(index_path, mmap_mode="r")
+            if is_valid is None or is_valid(array):
+                return array
+
+        array = build()
         try:
-            doc_enc_labels[
-                (arr_offset[:, 0] == 0) & (arr_offset[:, 1] != 0)
-            ] = doc_labels
-        except:
-            print(f"Error generating the encoding of line: {cnt}")
-            continue
-        encoded_labels.append(doc_enc_labels.tolist())
-        cnt += 1
+            os.makedirs(self.index_dir, exist_ok=True)
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as wd:
+                np.save(wd, array)
+            os.replace(tmp_path, index_path)
+        except OSError:
+            pass  # read-only folder, keep the index in memory
+        return array
+
+    def _build_offsets(self, chunk_size):
+        # start of each line: after each '\n', plus the end of the file
+        starts = [np.zeros(1, dtype=np.int64)]
+        with open(self.file_path, "rb") as rd:
+            position = 0
+            while True:
+                chunk = rd.read(chunk_size)
+                if not chunk:
+                    break
+                newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 10)
+                starts.append(newlines.astype(np.int64) + position + 1)
+                position += len(chunk)
+        offsets = np.concatenate(starts)
+        if offsets[-1] != os.path.getsize(self.file_path):
+            offsets = np.append(offsets, position)  # last line without '\n'
+        return offsets
+
+    @property
+    def mmap(self):
+        # one map per process (the datasets can be shared with forked workers)
+        if self._mmap_pid != os.getpid():
+            with open(self.file_path, "rb") as rd:
+                if os.path.getsize(self.file_path) == 0:
+                    self._mmap = b""
+                else:
+                    self._mmap = mmap.mmap(rd.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mmap_pid = os.getpid()
+        return self._mmap
+
+    def __getstate__(self):
+        # the map is not pickled, it is opened again by the new process
+        state = self.__dict__.copy()
+        state["_mmap"], state["_mmap_pid"] = None, None
+        return state
+
+    def __getitem__(self, idx):
+        start, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        return self.mmap[start:end].decode("utf8").rstrip("\n")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+def parse_utt2text_tags_line(line):
+    """Get the words and the tags of one line: <utt_id>;<text>;<tags>"""
+    line = line.strip().split(";")
+
+    # getting the text and tags (separated by ',')
+    text = line[1].rstrip().split(" ")
+    tags = line[2].rstrip().split(",")
+    return text, tags
+
+
+class LazyATCDataset_diarization(torch.utils.data.Dataset):
+    """Same as ATCDataset_diarization, but the utt2text_tags file is memory-mapped
+    and each line is parsed, tokenized and encoded only when it is accessed.
+    The memory is bounded, and once the file is indexed (first run, see
+    LineIndexedFile) the start-up time does not depend on its size.
+    The samples are not padded, use a DataCollatorForTokenClassification.
+
+    max_seq_len: max number of words in the sequence, longer lines are dropped like
+        in read_atc_diarization_data (the indices of the kept lines are cached with
+        the line index). None keeps all the lines
+    """
+
+    def __init__(self, file_path, tokenizer, tag2id, max_seq_len=60, index_dir=None):
+        self.lines = LineIndexedFile(file_path, index_dir=index_dir)
+        self.tokenizer = tokenizer
+        self.tag2id = tag2id
+        self.max_seq_len = max_seq_len
+
+        self.indices = None
+        if max_seq_len is not None:
+            self.indices = self.lines.cached_array(
+                f"max{max_seq_len}words", self._kept_lines
+            )
+
+    def _kept_lines(self):
+        """Indices of the lines with at most 'max_seq_len' words"""
+        return np.array(
+            [
+                idx
+                for idx in range(len(self.lines))
+                if len(parse_utt2text_tags_line(self.lines[idx])[0]) <= self.max_seq_len
+            ],
+            dtype=np.int64,
+        )
+
+    def __getitem__(self, idx):
+        if self.indices is not None:
+            idx = int(self.indices[idx])
+        text, tags = parse_utt2text_tags_line(self.lines[idx])
+
+        encodings = self.tokenizer(
+            [text],
+            is_split_into_words=True,
+            return_offsets_mapping=True,
+            truncation=True,
+        )
+        labels = encode_tags(self.tag2id, [tags], encodings)
+        encodings.pop("offset_mapping")
+
+        item = {key: torch.tensor(val[0]) for key, val in encodings.items()}
+        item["labels"] = torch.from_numpy(labels[0])
+        return item
+
+    def __len__(self):
+        if self.indices is not None:
+            return len(self.indices)
+        return len(self.lines)
+
+
+class TokenizedATCDataset_diarization(ATCDataset_diarization):
+    """ATCDataset_diarization stored in a folder (written by save_tokenized_dataset).
+    The columns are memory-mapped, so the processes that load the same folder
+    share their pages.
+    """
+
+    def __init__(self, folder, pad_to_longest=False):
+        self.folder = folder
+        with open(os.path.join(folder, "columns.json"), "r") as rd:
+            self.pad_values = json.load(rd)
+        self.offsets = np.load(os.path.join(folder, "offsets.npy"))
+        self.max_length = (
+            int(np.diff(self.offsets).max(initial=0)) if pad_to_longest else None
+        )
+        self._columns, self._columns_pid = None, None
+
+    @property
+    def columns(self):
+        # memory-mapped again in each process (like LineIndexedFile), copy-on-write
+        # so that torch gets writable arrays, the pages are shared until written
+        if self._columns_pid != os.getpid():
+            self._columns = {
+                key: torch.from_numpy(
+                    np.load(os.path.join(self.folder, f"{key}.npy"), mmap_mode="c")
+                )
+                for key in self.pad_values
+            }
+            self._columns_pid = os.getpid()
+        return self._columns
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_columns"], state["_columns_pid"] = None, None
+        return state
+
+
+class AugmentedATCDataset_diarization(torch.utils.data.IterableDataset):
+    """On-the-fly data augmentation (see data/utils/augmentation/data_augmentation_diarization.py).
+    The tokenized samples of 'dataset' are split in speaker turns (a turn starts
+    at each 'B-' tag, turns shorter than 'min_sentence_len' words are dropped), once.
+    Each epoch yields the samples of 'dataset' plus 'nb_samples' new ones, made of
+    1 or 2 (70% / 30%) random ATCO or pilot turns, in random order. The turns
+    are joined at the subword level: there is no tokenization and nothing is written.
+
+    The samples change at each epoch (one more per call to __iter__, or set_epoch),
+    and are split between the DataLoader workers.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        tokenizer,
+        id2tag,
+        nb_samples,
+        seed=1234,
+        min_sentence_len=3,
+        sentence_weights=(70, 30),
+        max_length=512,
+    ):
+        self.dataset = dataset
+        self.nb_samples = nb_samples
+        self.seed = seed
+        self.sentence_weights = np.array(sentence_weights) / sum(sentence_weights)
+        self.max_length = max_length
+        self.cls_id, self.sep_id = tokenizer.cls_token_id, tokenizer.sep_token_id
+        self.epoch = 0
+
+        id2tag = {int(k): v for k, v in id2tag.items()}
+        is_begin = np.zeros(max(id2tag) + 1, dtype=bool)
+        speaker = np.full(max(id2tag) + 1, -1, dtype=np.int64)
+        for idx, tag in id2tag.items():
+            is_begin[idx] = tag.startswith("B-")
+            speaker[idx] = 0 if "atco" in tag else 1 if "pilot" in tag else -1
+
+        # turns of each sample (without the special tokens), by speaker
+        input_ids, labels, turns = [], [], ([], [])
+        for idx in range(len(dataset)):
+            sample = dataset[idx]
+            sample_ids = sample["input_ids"].numpy()
+            sample_labels = sample["labels"].numpy()
+            words = np.flatnonzero(sample_labels != -100)
+            if len(words) == 0:
+                continue
+            begins = words[is_begin[sample_labels[words]]]
+            # the words before the first 'B-' tag go with the first turn
+            starts = np.unique(np.concatenate([words[:1], begins[begins > words[0]]]))
+            # the last turn ends at [SEP], after all the subwords of its last word
+            ends = np.append(starts[1:], int(sample["attention_mask"].sum()) - 1)
+
+            for start, end in zip(starts, ends):
+                turn_labels = sample_labels[start:end]
+                turn_words = turn_labels[turn_labels != -100]
+                turn_speakers = speaker[turn_words]
+                if len(turn_words) < min_sentence_len or (turn_speakers == -1).all():
+                    continue
+                # 'atco' turns first, like in extract_sentences_batch
+                turns[0 if (turn_speakers == 0).any() else 1].append(len(input_ids))
+                input_ids.append(sample_ids[start:end])
+                labels.append(turn_labels)
+
+        self.turn_ids = input_ids
+        self.turn_labels = labels
+        self.turns = [np.array(speaker_turns, dtype=np.int64) for speaker_turns in turns]
+        if nb_samples > 0 and (len(self.turns[0]) == 0 or len(self.turns[1]) == 0):
+            raise ValueError("The data augmentation needs ATCO and pilot turns")
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def compose(self, rng):
+        """New sample made of random ATCO or pilot turns"""
+        nb_sentences = rng.choice(len(self.sentence_weights), p=self.sentence_weights) + 1
+        turns = [
+            rng.choice(self.turns[rng.integers(2)]) for _ in range(nb_sentences)
+        ]
+        input_ids = np.concatenate(
+            [[self.cls_id]] + [self.turn_ids[turn] for turn in turns]
+        )[: self.max_length - 1]
+        labels = np.concatenate([[-100]] + [self.turn_labels[turn] for turn in turns])[
+            : self.max_length - 1
+        ]
+        input_ids = torch.from_numpy(np.append(input_ids, self.sep_id).astype(np.int64))
+        return {
+            "input_ids": input_ids,
+            "token_type_ids": torch.zeros_like(input_ids),
+            "attention_mask": torch.ones_like(input_ids),
+            "labels": torch.from_numpy(np.append(labels, -100).astype(np.int64)),
+        }
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        self.epoch += 1
+
+        # the same order in all the workers, each one takes its part
+        order = rng.permutation(len(self))
+        worker = torch.utils.data.get_worker_info()
+        if worker is not None:
+            order = order[worker.id :: worker.num_workers]
+            rng = np.random.default_rng([self.seed, self.epoch - 1, worker.id + 1])
+
+        for idx in order:
+            if idx < len(self.dataset):
+                yield self.dataset[int(idx)]
+            else:
+                yield self.compose(rng)
+
+    def __len__(self):
+        return len(self.dataset) + self.nb_samples
+
+
+def read_atc_diarization_tags(file_path):
+    """Get the set of tags of a utt2text_tags file, reading it line by line"""
+    unique_tags = set()
+    with open(file_path, "r", encoding="utf8") as f:
+        for sample in f:
+            unique_tags.update(parse_utt2text_tags_line(sample)[1])
+    return unique_tags
+
+
+class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    """Batch sampler that groups utterances of similar length.
+    The utterances are sorted by their number of subwords and each batch
+    is filled until 'max_tokens' (batch size x longest sequence) is reached.
+    This reduces the amount of padding compared to batches in file order.
+
+    sizes: number of sequences of each utterance (e.g., its windows, of at most
+        'lengths' subwords), default 1. They all count in the batch size
+    """
+
+    def __init__(self, lengths, max_tokens, max_batch_size=None, sizes=None):
+        self.lengths = lengths
+        self.sizes = sizes
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        if sizes is None:
+            sizes = np.ones(len(lengths), dtype=np.int64)
+
+        batches, batch, batch_len, batch_rows = [], [], 0, 0
+        for idx in np.argsort(lengths, kind="stable").tolist():
+            new_len = max(batch_len, lengths[idx])
+            is_full = new_len * (batch_rows + sizes[idx]) > max_tokens or (
+                max_batch_size is not None and len(batch) >= max_batch_size
+            )
+            if len(batch) > 0 and is_full:
+                batches.append(batch)
+                batch, new_len, batch_rows = [], lengths[idx], 0
+            batch.append(idx)
+            batch_len = new_len
+            batch_rows += sizes[idx]
+
+        if len(batch) > 0:
+            batches.append(batch)
+        self.batches = batches
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def padding_ratio(self):
+        """Fraction of the padded batches that is made of padding tokens"""
+        return padding_ratio(self.lengths, self.batches, self.sizes)
 
-    return encoded_labels
+
+def padding_ratio(lengths, batches, sizes=None):
+    """Compute the fraction of padding tokens when 'batches' (lists of indices)
+    are padded to their longest sequence, given the length of each sequence.
+    With 'sizes' (sequences per item, e.g., windows) all the sequences of an item
+    are counted with its length, so the ratio is a lower bound
+    """
+    padded_tokens, real_tokens = 0, 0
+    for batch in batches:
+        batch_lengths = [lengths[idx] for idx in batch]
+        batch_sizes = [1 if sizes is None else sizes[idx] for idx in batch]
+        padded_tokens += max(batch_lengths) * sum(batch_sizes)
+        real_tokens += sum(
+            length * size for length, size in zip(batch_lengths, batch_sizes)
+        )
+
+    if padded_tokens == 0:
+        return 0.0
+    return 1 - real_tokens / padded_tokens
+
+
+def get_sequence_lengths(dataset):
+    """Number of tokens (subwords, without padding) of each sample of a dataset.
+    For ATCDataset_diarization (or a Subset of it) they come from the offsets
+    """
+    if isinstance(dataset, torch.utils.data.Subset) and isinstance(
+        dataset.dataset, ATCDataset_diarization
+    ):
+        lengths = np.diff(dataset.dataset.offsets)
+        return lengths[np.asarray(dataset.indices)].tolist()
+    if isinstance(dataset, ATCDataset_diarization):
+        return np.diff(dataset.offsets).tolist()
+    return [len(dataset[idx]["input_ids"]) for idx in range(len(dataset))]
+
+
+def lookup_tag_ids(tag2id, tags):
+    """Ids of a flat list of tags, with a binary search in the sorted tags
+    (KeyError if a tag is not in tag2id)
+    """
+    if len(tags) == 0:
+        return np.zeros(0, dtype=np.int64)
+    keys = np.array(sorted(tag2id))
+    tags = np.array(tags)
+    index = np.searchsorted(keys, tags).clip(max=len(keys) - 1)
+    unknown = keys[index] != tags
+    if unknown.any():
+        raise KeyError(str(tags[unknown][0]))
+    return np.array([tag2id[key] for key in keys], dtype=np.int64)[index]
+
+
+def align_tags(tag2id, tags, encodings):
+    """Vectorized alignment of the word tags to the subwords of the (fast tokenizer)
+    encodings: the label of each word goes to its first subword, the rest of the
+    subwords and the special tokens get -100 (not used during loss calculation).
+    Returns the labels of each line (views of one flat array) and the indices
+    of the lines where the number of words differs from the number of tags
+    (e.g., truncated lines), all their labels are -100
+    """
+    word_ids = [encoding.word_ids for encoding in encodings.encodings]
+    lengths = np.fromiter(map(len, word_ids), dtype=np.int64, count=len(word_ids))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    # word index of each subword of the corpus, -1 for the special tokens
+    flat_word_ids = np.array(
+        list(itertools.chain.from_iterable(word_ids)), dtype=np.float64
+    )
+    flat_word_ids = np.nan_to_num(flat_word_ids, nan=-1).astype(np.int64)
+    line_ids = np.repeat(np.arange(len(lengths)), lengths)
+
+    # words seen by the tokenizer vs. tags, per line
+    nb_words = np.zeros(len(lengths), dtype=np.int64)
+    non_empty = lengths > 0
+    if non_empty.any():
+        nb_words[non_empty] = (
+            np.maximum.reduceat(flat_word_ids, offsets[:-1][non_empty]) + 1
+        )
+    nb_tags = np.fromiter(map(len, tags), dtype=np.int64, count=len(tags))
+    tag_offsets = np.cumsum(nb_tags) - nb_tags
+    flat_tag_ids = lookup_tag_ids(tag2id, list(itertools.chain.from_iterable(tags)))
+    mismatches = np.flatnonzero(nb_words != nb_tags)
+
+    # first subword of each word, only in the lines that match
+    is_first = flat_word_ids != -1
+    is_first[1:] &= (flat_word_ids[1:] != flat_word_ids[:-1]) | (
+        line_ids[1:] != line_ids[:-1]
+    )
+    is_first &= (nb_words == nb_tags)[line_ids]
+
+    flat_labels = np.full(len(flat_word_ids), -100, dtype=np.int64)
+    flat_labels[is_first] = flat_tag_ids[
+        tag_offsets[line_ids[is_first]] + flat_word_ids[is_first]
+    ]
+    labels = [
+        flat_labels[start:end]
+        for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())
+    ]
+    return labels, mismatches.tolist()
+
+
+def encode_tags(tag2id, tags, encodings):
+    """Function to encode the tags in the format needed by the model.
+    This is due to using of subword units (see align_tags). One label array
+    per line, the lines where the tags do not match the words are reported
+    and get -100 labels (they are not used during training)
+    """
+    labels, mismatches = align_tags(tag2id, tags, encodings)
+    for idx in mismatches:
+        print(f"Error generating the encoding of line: {idx}")
+    return labels
 
 
 def clean_input_utterance(input_text):
@@ -92,20 +608,17 @@ def read_atc_diarization_data(file_path, max_seq_len=60):
     PyTorch dataset object with the data for faster loading.
 
     max_seq_len: max number of words in the sequence, otherwise
-        we might get out-of-memmory issues
+        we might get out-of-memmory issues. None keeps all the sequences
+        (e.g., to tag them in windows, see DiarizationEngine)
     """
 
     token_docs = []
     tag_docs = []
     with open(file_path, "r", encoding="utf8") as f:
         for sample in f:
-            line = sample.strip().split(";")
-
-            # getting the text and tags (separated by ',')
-            text = line[1].rstrip().split(" ")
-            tags = line[2].rstrip().split(",")
+            text, tags = parse_utt2text_tags_line(sample)
 
-            if len(text) > max_seq_len:
+            if max_seq_len is not None and len(text) > max_seq_len:
                 continue
             token_docs.append(text)
             tag_docs.append(tags)
@@ -113,6 +626,112 @@ def read_atc_diarization_data(file_path, max_seq_len=60):
     return token_docs, tag_docs
 
 
+# changed when the stored data changes (e.g., the label alignment, see align_tags)
+TOKENIZED_CACHE_FORMAT = 2
+
+
+def tokenized_cache_key(file_path, tokenizer, tag2id, max_seq_len=60):
+    """Key of the tokenized version of a utt2text_tags file: hash of the content
+    of the file, of the (fast) tokenizer, of tag2id and of max_seq_len
+    """
+    key = hashlib.sha1()
+    with open(file_path, "rb") as rd:
+        for chunk in iter(lambda: rd.read(1024**2), b""):
+            key.update(chunk)
+
+    # the truncation/padding state of the tokenizer changes with the calls
+    state = json.loads(tokenizer.backend_tokenizer.to_str())
+    state.pop("truncation", None)
+    state.pop("padding", None)
+    key.update(json.dumps(state, sort_keys=True).encode())
+    key.update(str(tokenizer.model_max_length).encode())
+
+    key.update(json.dumps(tag2id, sort_keys=True).encode())
+    key.update(repr(max_seq_len).encode())
+    key.update(f"format:{TOKENIZED_CACHE_FORMAT}".encode())
+    return key.hexdigest()
+
+
+def save_tokenized_dataset(folder, encodings, labels, tokenizer):
+    """Store the encodings (without offset_mapping) and labels in 'folder', in the
+    format of TokenizedATCDataset_diarization. The folder is written atomically,
+    if another process wrote it first, its version is kept
+    """
+    columns, offsets = flatten_columns(encodings, labels)
+
+    os.makedirs(os.path.dirname(os.path.abspath(folder)), exist_ok=True)
+    tmp_folder = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(folder)))
+    for key, values in columns.items():
+        np.save(os.path.join(tmp_folder, f"{key}.npy"), values)
+    np.save(os.path.join(tmp_folder, "offsets.npy"), offsets)
+    with open(os.path.join(tmp_folder, "columns.json"), "w") as wr:
+        json.dump(get_pad_values(tokenizer, columns), wr)
+
+    try:
+        os.rename(tmp_folder, folder)
+    except OSError:
+        shutil.rmtree(tmp_folder)
+
+
+def get_pad_values(tokenizer, keys):
+    """Padding value of each key of the encodings"""
+    pad_values = {
+        "input_ids": tokenizer.pad_token_id,
+        "token_type_ids": tokenizer.pad_token_type_id,
+        "labels": -100,
+    }
+    return {key: pad_values.get(key, 0) for key in keys}
+
+
+def load_diarization_dataset(
+    file_path, tokenizer, tag2id, padding=True, cache_dir=None
+):
+    """Read, tokenize and encode the tags of a utt2text_tags file.
+    Returns an ATCDataset_diarization ready for the forward pass.
+
+    padding: pad all the samples to the longest one, otherwise the batches have
+        to be padded by a DataCollatorForTokenClassification
+    cache_dir: if given, the tokenized data is stored in (or loaded from)
+        '<cache_dir>/<key>', see tokenized_cache_key. Other runs with the same
+        file, tokenizer and tag2id skip the tokenization
+    """
+    if cache_dir is not None:
+        folder = os.path.join(
+            cache_dir, tokenized_cache_key(file_path, tokenizer, tag2id)
+        )
+        if os.path.isdir(folder):
+            print(f"Loading the tokenized data of {file_path} from: {folder}")
+            return TokenizedATCDataset_diarization(folder, pad_to_longest=padding)
+
+    texts, tags = read_atc_diarization_data(file_path)
+    # the tokenizer takes an empty list as one empty utterance
+    if len(texts) == 0:
+        return ATCDataset_diarization(
+            {key: [] for key in tokenizer.model_input_names}, [], pad_to_longest=padding
+        )
+
+    # Tokenize and package data for forward pass (padded by the dataset),
+    encodings = tokenizer(
+        texts,
+        is_split_into_words=True,
+        return_offsets_mapping=True,
+        truncation=True,
+    )
+    labels = encode_tags(tag2id, tags, encodings)
+    encodings.pop("offset_mapping")  # we don't want to pass this to the model
+
+    if cache_dir is not None:
+        save_tokenized_dataset(folder, encodings, labels, tokenizer)
+        print(f"Tokenized data of {file_path} stored in: {folder}")
+        return TokenizedATCDataset_diarization(folder, pad_to_longest=padding)
+    return ATCDataset_diarization(
+        encodings,
+        labels,
+        pad_to_longest=padding,
+        pad_values=get_pad_values(tokenizer, list(encodings.keys()) + ["labels"]),
+    )
+
+
 def get_index_value(raw_pred):
     """get the index and confidence given the outputs. We use a SoftMax Layer"""
 
@@ -158,12 +777,13 @@ def compute_metrics_sklearn(p):
     return report
 
 
-def compute_metrics(predictions, labels, label_list, log_folder=None):
-    """Function to compute the 'seqeval' metric used for NER datasets
-    First we load the function and then we evaluate a specific dataset:
-    predictions, labels and label_list (id2tag) are used to compute it.
+def get_word_level_tags(predictions, labels, label_list):
+    """Get the flat lists of predicted and true tags, only for the subwords
+    that have a label (first subword of each word, the rest are -100).
+    The predictions are logits (N, L, C) or tag ids (N, L)
     """
-    predictions = np.argmax(predictions, axis=2)
+    if predictions.ndim == 3:
+        predictions = np.argmax(predictions, axis=2)
 
     # Remove ignored index (special tokens)
     true_predictions = [
@@ -175,9 +795,29 @@ def compute_metrics(predictions, labels, label_list, log_folder=None):
         for prediction, label in zip(predictions, labels)
     ]
 
+    true_labels = [item for sublist in true_labels for item in sublist]
+    true_predictions = [item for sublist in true_predictions for item in sublist]
+    return true_predictions, true_labels
+
+
+def compute_jer(predictions, labels, label_list):
+    """Weighted Jaccard error rate (JER, in %) of the predictions"""
+    true_predictions, true_labels = get_word_level_tags(predictions, labels, label_list)
+    jaccard_weighted = jaccard_score(
+        y_true=true_labels, y_pred=true_predictions, average="weighted"
+    )
+    return (1 - jaccard_weighted) * 100
+
+
+def compute_metrics(predictions, labels, label_list, log_folder=None):
+    """Function to compute the 'seqeval' metric used for NER datasets
+    First we load the function and then we evaluate a specific dataset:
+    predictions, labels and label_list (id2tag) are used to compute it.
+    """
     # producing a classification report
-    true_labels2 = [item for sublist in true_labels for item in sublist]
-    true_predictions2 = [item for sublist in true_predictions for item in sublist]
+    true_predictions2, true_labels2 = get_word_level_tags(
+        predictions, labels, label_list
+    )
     results = compute_metrics_sklearn([true_predictions2, true_labels2])
 
     # save the metrics in file if log_folder is given, otherwise only print
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: Copyright © <2022> Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Juan Zuluaga-Gomez <jzuluaga@idiap.ch>
+#
+# SPDX-License-Identifier: MIT-License
+
+"""
+    Script to train a small text-based diarization model (student) by knowledge
+    distillation from a fine-tuned one (teacher, output of train_diarization.py):
+        1. the teacher tags the training data (and optionally augmented data,
+           see data/utils/augmentation/data_augmentation_diarization.py), its
+           logits are cached on disk, so other student runs do not recompute them
+        2. the student is trained with: alpha * KL(teacher || student) + (1 - alpha) * CE
+
+    The student is a smaller BERT with the same vocabulary, e.g.,
+    google/bert_uncased_L-4_H-512_A-8 (4 layers, hidden size of 512), or the
+    teacher itself truncated to its first N layers (--student-layers).
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import random
+import sys
+
+import numpy as np
+import torch
+import transformers
+from sklearn.model_selection import train_test_split
+from transformers import (
+    AutoModelForTokenClassification,
+    AutoTokenizer,
+    DataCollatorForTokenClassification,
+    Trainer,
+    TrainingArguments,
+    set_seed,
+)
+
+from diarization_cache import model_fingerprint
+from diarization_engine import DiarizationEngine
+from diarization_utils import (
+    ATCDataset_diarization,
+    align_tags,
+    compute_jer,
+    compute_metrics,
+    encode_tags,
+    read_atc_diarization_data,
+)
+
+logger = logging.getLogger(__name__)
+
+# folder (in the teacher folder) where the teacher logits are cached
+TEACHER_LOGITS_FOLDER = "teacher_logits"
+
+
+class DistillationDataset(torch.utils.data.Dataset):
+    """\
+    Samples (not padded) with the hard labels and the logits of the teacher
+    for each subword. The logits of all the samples are stored in one flat
+    array (memory-mapped), 'offsets' holds the first row of each sample.
+    """
+
+    def __init__(self, encodings, labels, logits, offsets):
+        self.encodings = encodings
+        self.labels = labels
+        self.logits = logits
+        self.offsets = offsets
+
+    def __getitem__(self, idx):
+        item = {key: torch.tensor(val[idx]) for key, val in self.encodings.items()}
+        item["labels"] = torch.tensor(self.labels[idx])
+        item["teacher_logits"] = torch.from_numpy(
+            np.asarray(
+                self.logits[self.offsets[idx] : self.offsets[idx + 1]], dtype=np.float32
+            )
+        )
+        return item
+
+    def __len__(self):
+        return len(self.labels)
+
+
+class DistillationCollator:
+    """Pad the samples like DataCollatorForTokenClassification, and the teacher
+    logits with zeros (the padded positions are masked in the loss)
+    """
+
+    def __init__(self, tokenizer):
+        self.collator = DataCollatorForTokenClassification(tokenizer)
+
+    def __call__(self, features):
+        teacher_logits = [feature.pop("teacher_logits", None) for feature in features]
+        batch = self.collator(features)
+        if teacher_logits[0] is None:
+            return batch
+
+        length = batch["input_ids"].shape[1]
+        padded = torch.zeros(len(features), length, teacher_logits[0].shape[-1])
+        for idx, logits in enumerate(teacher_logits):
+            padded[idx, : logits.shape[0]] = logits
+        batch["teacher_logits"] = padded
+        return batch
+
+
+class DistillationTrainer(Trainer):
+    """Trainer with the distillation loss: alpha * KL * T^2 + (1 - alpha) * CE.
+    The samples without teacher logits (e.g., evaluation) only use the CE loss.
+    """
+
+    def __init__(self, *args, alpha=0.5, temperature=2.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.alpha = alpha
+        self.temperature = temperature
+
+    def compute_loss(self, model, inputs, return_outputs=False):
+        teacher_logits = inputs.pop("teacher_logits", None)
+        outputs = model(**inputs)
+        loss = outputs.loss
+        if teacher_logits is None:
+            return (loss, outputs) if return_outputs else loss
+
+        # KL divergence on all the (not padded) subwords, with soft targets
+        T = self.temperature
+        kl = torch.nn.functional.kl_div(
+            torch.log_softmax(outputs.logits / T, dim=-1),
+            torch.softmax(teacher_logits / T, dim=-1),
+            reduction="none",
+        ).sum(-1)
+        mask = inputs["attention_mask"].to(kl.dtype)
+        kl = (kl * mask).sum() / mask.sum()
+
+        loss = self.alpha * kl * T**2 + (1 - self.alpha) * loss
+        return (loss, outputs) if return_outputs else loss
+
+
+def teacher_logits_key(path_to_teacher, path_to_files, *extra):
+    """Key of the cached teacher logits: teacher model, data files and 'extra'
+    options that change the training samples (e.g., seed of the train/dev split)
+    """
+    key = hashlib.sha1(model_fingerprint(path_to_teacher).encode())
+    for path_to_file in path_to_files:
+        stat = os.stat(path_to_file)
+        key.update(
+            f"{os.path.abspath(path_to_file)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+        )
+    key.update(repr(extra).encode())
+    return key.hexdigest()[:16]
+
+
+def compute_teacher_logits(engine, encodings, batch_size=32):
+    """Run the teacher on the (not padded) encodings. Returns the float16 logits
+    of all the subwords in one flat array (N, C), and the offsets of each sample
+    """
+    lengths = np.array([len(input_ids) for input_ids in encodings["input_ids"]])
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    logits = np.zeros((offsets[-1], engine.model.config.num_labels), dtype=np.float16)
+
+    keys = ["input_ids", "attention_mask", "token_type_ids"]
+    for start in range(0, len(lengths), batch_size):
+        end = min(start + batch_size, len(lengths))
+        batch = engine.tokenizer.pad(
+            {key: encodings[key][start:end] for key in keys}, return_tensors="pt"
+        )
+        batch_logits = engine.forward(batch).float().cpu().numpy()
+        for idx in range(start, end):
+            logits[offsets[idx] : offsets[idx + 1]] = batch_logits[
+                idx - start, : lengths[idx]
+            ]
+    return logits, offsets
+
+
+def load_teacher_logits(engine, encodings, path_to_cache, batch_size=32):
+    """Load the cached teacher logits, or compute and store them"""
+    path_to_logits = f"{path_to_cache}.logits.npy"
+    path_to_offsets = f"{path_to_cache}.offsets.npy"
+
+    if os.path.isfile(path_to_logits) and os.path.isfile(path_to_offsets):
+        logger.info(f"*** Loading the cached teacher logits: {path_to_logits} ***")
+        return np.load(path_to_logits, mmap_mode="r"), np.load(path_to_offsets)
+
+    logger.info("*** Computing the teacher logits ***")
+    logits, offsets = compute_teacher_logits(engine, encodings, batch_size=batch_size)
+    os.makedirs(os.path.dirname(path_to_logits), exist_ok=True)
+    np.save(path_to_logits, logits)
+    np.save(path_to_offsets, offsets)
+    return np.load(path_to_logits, mmap_mode="r"), offsets
+
+
+def load_student_model(path_to_student, num_labels, student_layers=None):
+    """Load the (smaller) student model, optionally keeping only its first N layers"""
+    student = AutoModelForTokenClassification.from_pretrained(
+        path_to_student, num_labels=num_labels, ignore_mismatched_sizes=True
+    )
+    if student_layers is not None:
+        if student_layers > student.config.num_hidden_layers:
+            raise ValueError(
+                f"The student has only {student.config.num_hidden_layers} layers"
+            )
+        student.bert.encoder.layer = student.bert.encoder.layer[:student_layers]
+        student.config.num_hidden_layers = student_layers
+    return student
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    # reporting vars
+    parser.add_argument(
+        "--report-to",
+        type=str,
+        default=None,
+        help="Where to report the results, you can choose e.g., WANDB",
+    )
+
+    # distillation parameters
+    parser.add_argument(
+        "-t",
+        "--teacher-model",
+        required=True,
+        help="Folder where the fine-tuned teacher model is stored",
+    )
+    parser.add_argument(
+        "--student-model",
+        default="google/bert_uncased_L-4_H-512_A-8",
+        help="Pretrained (smaller) model used as student, it needs the vocabulary of the teacher",
+    )
+    parser.add_argument(
+        "--student-layers",
+        type=int,
+        default=None,
+        help="Keep only the first N layers of the student, e.g., '--student-model <teacher> --student-layers 6'",
+    )
+    parser.add_argument(
+        "--alpha",
+        type=float,
+        default=0.5,
+        help="Weight of the KL (teacher) loss, the CE loss gets 1 - alpha",
+    )
+    parser.add_argument(
+        "--temperature",
+        type=float,
+        default=2.0,
+        help="Temperature of the softmax of the teacher and the student in the KL loss",
+    )
+    parser.add_argument(
+        "--augmented-data",
+        default=None,
+        help="String with paths to augmented utt2text_tags files (data_augmentation_diarization.py), added to the training data",
+    )
+    parser.add_argument(
+        "--teacher-cache",
+        default=None,
+        help="Folder where to cache the teacher logits, default: <teacher-model>/teacher_logits",
+    )
+
+    # some training parameters
+    parser.add_argument(
+        "-e",
+        "--epochs",
+        type=int,
+        default=5,
+        help="Number of epochs of fine-tuning/training",
+    )
+    parser.add_argument(
+        "-s", "--seed", type=int, default=1234, help="Seed for training"
+    )
+    parser.add_argument(
+        "-tb", "--train-batch-size", type=int, default=32, help="Training batch size"
+    )
+    parser.add_argument(
+        "-eb", "--eval-batch-size", type=int, default=16, help="Evaluation batch size"
+    )
+    parser.add_argument(
+        "--gradient-accumulation-steps",
+        type=int,
+        default=2,
+        help="Number of gradient accumulation steps",
+    )
+    parser.add_argument(
+        "--warmup-steps", type=int, default=500, help="Number of warm up steps"
+    )
+    parser.add_argument(
+        "--logging-steps", type=int, default=1000, help="Logging steps size"
+    )
+    parser.add_argument(
+        "--save-steps", type=int, default=1000, help="Number of steps to save the model"
+    )
+    parser.add_argument(
+        "--eval-steps", type=int, default=500, help="Perform evaluation each N steps"
+    )
+    parser.add_argument(
+        "--max-steps",
+        type=int,
+        default=3000,
+        help="Maximum number of steps to train the model",
+    )
+
+    parser.add_argument(
+        "--val-data",
+        default=None,
+        help="Validation file for the token classification model (utt2text_tags)",
+    )
+    parser.add_argument(
+        "--test-data", default=None, help="Test file for the token classification model (utt2text_tags)"
+    )
+
+    parser.add_argument(
+        "train_data",
+        help="Train file used for training a text-based diarization system (utt2text_tags)",
+    )
+    parser.add_argument(
+        "output_folder",
+        help="name of the output folder to store the student model and tokenizer",
+    )
+    return parser.parse_args()
+
+
+def main(args):
+    """Main code execution"""
+
+    # Setup logging (following HuggingFace style)
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+    logger.setLevel(logging.INFO)
+    transformers.utils.logging.set_verbosity(logging.INFO)
+
+    # first, set all the seeds:
+    torch.manual_seed(args.seed)
+    random.seed(args.seed)
+    set_seed(args.seed)
+
+    output_directory = args.output_folder
+
+    # the teacher defines the tags and the tokenizer (shared with the student)
+    logger.info("*** Loading the teacher model and the tokenizer ***")
+    tokenizer = AutoTokenizer.from_pretrained(
+        args.teacher_model, use_fast=True, do_lower_case=True
+    )
+    teacher = AutoModelForTokenClassification.from_pretrained(args.teacher_model)
+    engine = DiarizationEngine(teacher, tokenizer)
+    tag2id = teacher.config.label2id
+    id2tag = {int(k): v for k, v in teacher.config.id2label.items()}
+
+    # read train (+ augmented) and validation data
+    train_files = [args.train_data]
+    if args.augmented_data is not None:
+        train_files += args.augmented_data.rstrip().split(" ")
+
+    train_texts, train_tags = [], []
+    for path_to_file in train_files:
+        texts, tags = read_atc_diarization_data(path_to_file)
+        train_texts += texts
+        train_tags += tags
+
+    if args.val_data:
+        val_texts, val_tags = read_atc_diarization_data(args.val_data)
+    else:
+        logger.info("*** No validation data, splitting it in train/dev from train ***")
+        percentage = 0.1 if len(train_texts) < 100000 else 5000 / len(train_texts)
+        train_texts, val_texts, train_tags, val_tags = train_test_split(
+            train_texts, train_tags, test_size=percentage, random_state=args.seed
+        )
+
+    # the training samples are not padded, the collator pads each batch
+    logger.info("*** Tokenizing the train/val sets ***")
+    train_encodings = tokenizer(
+        train_texts,
+        is_split_into_words=True,
+        return_offsets_mapping=True,
+        truncation=True,
+    )
+    train_labels, mismatches = align_tags(tag2id, train_tags, train_encodings)
+    if len(mismatches) > 0:
+        raise ValueError(
+            f"The tags of some training samples do not match their words: {mismatches}"
+        )
+    train_encodings.pop("offset_mapping")
+
+    val_encodings = tokenizer(
+        val_texts,
+        is_split_into_words=True,
+        return_offsets_mapping=True,
+        padding=True,
+        truncation=True,
+    )
+    val_labels = encode_tags(tag2id, val_tags, val_encodings)
+    val_encodings.pop("offset_mapping")
+    val_dataset = ATCDataset_diarization(val_encodings, val_labels)
+
+    # soft targets of the teacher, cached on disk
+    path_to_cache = os.path.join(
+        args.teacher_cache
+        if args.teacher_cache is not None
+        else os.path.join(args.teacher_model, TEACHER_LOGITS_FOLDER),
+        teacher_logits_key(
+            args.teacher_model,
+            train_files + ([args.val_data] if args.val_data else []),
+            args.seed if not args.val_data else None,
+        ),
+    )
+    teacher_logits, offsets = load_teacher_logits(
+        engine, train_encodings, path_to_cache, batch_size=args.eval_batch_size
+    )
+    train_dataset = DistillationDataset(
+        train_encodings, train_labels, teacher_logits, offsets
+    )
+
+    # either, prepare the test set passed or use validation as 'final' test set
+    if args.test_data is not None:
+        test_texts, test_tags = read_atc_diarization_data(args.test_data)
+        test_encodings = tokenizer(
+            test_texts,
+            is_split_into_words=True,
+            return_offsets_mapping=True,
+            padding=True,
+            truncation=True,
+        )
+        test_labels = encode_tags(tag2id, test_tags, test_encodings)
+        test_encodings.pop("offset_mapping")
+        test_dataset = ATCDataset_diarization(test_encodings, test_labels)
+    else:
+        test_dataset = val_dataset
+
+    # Fetch the student model (Token Classification), with the labels of the teacher
+    logger.info(f"*** Loading the student model: {args.student_model} ***")
+    student = load_student_model(
+        args.student_model, len(tag2id), student_layers=args.student_layers
+    )
+    if student.config.vocab_size != teacher.config.vocab_size:
+        raise ValueError("The student and the teacher need the same vocabulary")
+    student.config.label2id = tag2id
+    student.config.id2label = id2tag
+
+    nb_teacher = sum(p.numel() for p in teacher.parameters())
+    nb_student = sum(p.numel() for p in student.parameters())
+    logger.info(
+        f"*** Teacher: {nb_teacher / 1e6:.1f}M parameters, {teacher.config.num_hidden_layers} layers. "
+        f"Student: {nb_student / 1e6:.1f}M parameters, {student.config.num_hidden_layers} layers ***"
+    )
+
+    def compute_metrics_training(p):
+        predictions, labels = p
+        return {"jer": compute_jer(predictions, labels, id2tag)}
+
+    # Define TrainingArguments for Trainer object
+    training_args = TrainingArguments(
+        report_to=args.report_to,
+        output_dir=output_directory,
+        num_train_epochs=args.epochs,
+        per_device_train_batch_size=args.train_batch_size,
+        per_device_eval_batch_size=args.eval_batch_size,
+        warmup_steps=args.warmup_steps,
+        weight_decay=0.001,
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        evaluation_strategy="steps",
+        logging_dir=output_directory + "/logs",
+        logging_steps=args.logging_steps,
+        max_steps=args.max_steps,
+        save_steps=args.save_steps,
+        eval_steps=args.eval_steps,
+        save_total_limit=1,
+    )
+
+    trainer = DistillationTrainer(
+        model=student,
+        args=training_args,
+        train_dataset=train_dataset,
+        eval_dataset=val_dataset,
+        compute_metrics=compute_metrics_training,
+        data_collator=DistillationCollator(tokenizer),
+        alpha=args.alpha,
+        temperature=args.temperature,
+    )
+
+    logger.info("*** Training the student ***")
+    train_results = trainer.train()
+    trainer.log_metrics("train", train_results.metrics)
+    trainer.save_metrics("train", train_results.metrics)
+    trainer.save_state()
+    trainer.save_model(output_dir=f"{output_directory}/")
+    tokenizer.save_pretrained(f"{output_directory}/")
+
+    # compare the JER of the student and the teacher on the test set
+    logger.info("*** Evaluate ***")
+    raw_pred, raw_labels, _ = trainer.predict(test_dataset)
+    compute_metrics(
+        raw_pred,
+        raw_labels,
+        label_list=id2tag,
+        log_folder=f"{output_directory}/classification_report",
+    )
+    teacher_pred, teacher_labels = engine.predict_logits(
+        test_dataset, batch_size=args.eval_batch_size
+    )
+
+    jer_student = compute_jer(raw_pred, raw_labels, id2tag)
+    jer_teacher = compute_jer(teacher_pred, teacher_labels, id2tag)
+    report = f"JER teacher: {jer_teacher:.2f} | JER student: {jer_student:.2f} | difference: {jer_student - jer_teacher:.2f}"
+    print(report)
+    print(report, file=open(f"{output_directory}/distillation_report", "w"))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -18,23 +18,21 @@
 
 import argparse
 import os
+import time
 
-from transformers import (
-    AutoModelForTokenClassification,
-    AutoTokenizer,
-    DataCollatorWithPadding,
-    Trainer,
-)
+import numpy as np
+from transformers import AutoTokenizer, DataCollatorWithPadding, Trainer
 
+from diarization_engine import DiarizationEngine, load_token_classification_model
 from diarization_utils import (
-    ATCDataset_diarization,
+    compute_jer,
     compute_metrics,
-    encode_tags,
+    load_diarization_dataset,
     read_atc_diarization_data,
 )
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -51,6 +49,41 @@ def parse_args():
         default=1,
         help="Batch size you want to use for decoding",
     )
+    parser.add_argument(
+        "--backend",
+        choices=["pytorch", "onnxruntime", "torchscript"],
+        default="pytorch",
+        help="Run the model with PyTorch, with ONNX Runtime (CPU, needs the model exported with export_onnx.py) or traced with TorchScript (CPU, inputs padded to shape buckets)",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        help="If > 0, prepare the batches in a producer thread (queue of N batches) while the model runs, instead of using the HF Trainer",
+    )
+    parser.add_argument(
+        "--window-size",
+        type=int,
+        default=0,
+        help="If > 0, keep the utterances longer than 60 words and tag them in overlapping windows of N words",
+    )
+    parser.add_argument(
+        "--window-stride",
+        type=int,
+        default=None,
+        help="Number of words between the starts of two windows, default: window size / 2",
+    )
+    parser.add_argument(
+        "--exit-thresholds",
+        default=None,
+        help="(models trained with --early-exit-layers) String with the early exit thresholds to evaluate, e.g., '0.9 0.95 0.99'",
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Folder where the tokenized test sets are stored, the evaluations with the same files and tokenizer reuse them",
+    )
 
     parser.add_argument(
         "-m",
@@ -78,7 +111,53 @@ def parse_args():
         help="Folder where the final model is stored",
     )
 
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.exit_thresholds is not None and args.window_size > 0:
+        parser.error("--exit-thresholds can not be used with --window-size")
+    return args
+
+
+def predict_word_tags(engine, texts, tags, tag2id, batch_size=1):
+    """Tag the utterances with the engine (e.g., in windows) and return the word-level
+    predictions (one-hot) and labels, padded with -100, in the format of compute_metrics
+    """
+    max_words = max((len(words) for words in texts), default=0)
+    predictions = np.zeros((len(texts), max_words, len(tag2id)), dtype=np.float32)
+    labels = np.full((len(texts), max_words), -100, dtype=np.int64)
+    if len(texts) == 0:
+        return predictions, labels
+
+    for start in range(0, len(texts), batch_size):
+        outputs = engine.predict(texts[start : start + batch_size])
+        for idx, output in enumerate(outputs, start):
+            nb_words = len(output["tag_ids"])
+            predictions[idx, np.arange(nb_words), output["tag_ids"]] = 1
+            labels[idx, :nb_words] = [tag2id[tag] for tag in tags[idx][:nb_words]]
+    return predictions, labels
+
+
+def early_exit_report(engine, dataset, thresholds, id2tag, batch_size=1):
+    """Speed / JER trade-off of the early exit thresholds (None is the full model)"""
+    lines = ["threshold | avg. layers | time (s) | JER (%)"]
+    for threshold in [None] + thresholds:
+        engine.exit_threshold = threshold
+        engine.reset_depth_stats()
+
+        start = time.perf_counter()
+        raw_pred, raw_labels = engine.predict_logits(dataset, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+
+        depth = (
+            engine.average_depth()
+            if threshold is not None
+            else engine.model.config.num_hidden_layers
+        )
+        jer = compute_jer(raw_pred, raw_labels, id2tag)
+        lines.append(
+            f"{'full' if threshold is None else threshold:>9} | {depth:11.2f} | {elapsed:8.3f} | {jer:7.2f}"
+        )
+    engine.exit_threshold = None
+    return "\n".join(lines)
 
 
 def main(args):
@@ -100,14 +179,21 @@ def main(args):
 
     print("\nLoading the TOKEN classification recognition model (TEXT-DIARIZATION)\n")
     # Fetch the Model and tokenizer
-    eval_model = AutoModelForTokenClassification.from_pretrained(
-        token_classification_model
+    eval_model = load_token_classification_model(
+        token_classification_model, backend=args.backend
     )
 
     tokenizer = AutoTokenizer.from_pretrained(
         token_classification_model, use_fast=True, do_lower_case=True
     )
 
+    if args.exit_thresholds is not None and not hasattr(
+        eval_model, "forward_early_exit"
+    ):
+        raise ValueError(
+            "--exit-thresholds needs a pytorch model trained with --early-exit-layers"
+        )
+
     # get the labels of the model
     tag2id = eval_model.config.label2id
     id2tag = eval_model.config.id2label
@@ -115,8 +201,27 @@ def main(args):
     # cast the standard DataCollator
     data_collator = DataCollatorWithPadding(tokenizer)
 
-    # Trainer, only  instantiated for testing
-    trainer = Trainer(model=eval_model, data_collator=data_collator)
+    # Trainer, only  instantiated for testing. ONNX Runtime models, or if prefetch is
+    # set, run with the engine
+    use_trainer = (
+        args.backend == "pytorch"
+        and args.prefetch == 0
+        and args.window_size == 0
+        and args.exit_thresholds is None
+    )
+    if args.window_size > 0:
+        # word-level tags (first subword), stitched from the windows of each utterance
+        engine = DiarizationEngine(
+            eval_model,
+            tokenizer,
+            aggregation="first",
+            window_size=args.window_size,
+            window_stride=args.window_stride,
+        )
+    elif use_trainer:
+        trainer = Trainer(model=eval_model, data_collator=data_collator)
+    else:
+        engine = DiarizationEngine(eval_model, tokenizer)
 
     # main loop,
     for path_to_file, dataset_name in zip(path_to_files, test_set_names):
@@ -125,28 +230,58 @@ def main(args):
         print(f"----    Evaluating dataset: --> {dataset_name} -----")
 
         # converting the data to model's format,
-        eval_texts, eval_tags = read_atc_diarization_data(path_to_file)
+        if args.window_size > 0:
+            # the long utterances are not dropped, they are tagged in windows
+            eval_texts, eval_tags = read_atc_diarization_data(
+                path_to_file, max_seq_len=None
+            )
+            if len(eval_texts) == 0:
+                print(f"No utterances in: {path_to_file}, skipping it")
+                continue
+            raw_pred, raw_labels = predict_word_tags(
+                engine, eval_texts, eval_tags, tag2id, batch_size=args.batch_size
+            )
+            compute_metrics(
+                raw_pred,
+                raw_labels,
+                label_list=id2tag,
+                log_folder=f"{output_folder}/{dataset_name}_metrics",
+            )
+            continue
 
         # Tokenize, pad and package data for forward pass,
-        eval_encodings = tokenizer(
-            eval_texts,
-            is_split_into_words=True,
-            return_offsets_mapping=True,
-            padding=True,
-            truncation=True,
+        eval_dataset = load_diarization_dataset(
+            path_to_file, tokenizer, tag2id, cache_dir=args.cache_dir
         )
-        eval_labels = encode_tags(tag2id, eval_tags, eval_encodings)
-        eval_encodings.pop("offset_mapping")  # we don't want to pass this to the model
-        eval_dataset = ATCDataset_diarization(eval_encodings, eval_labels)
+        if len(eval_dataset) == 0:
+            print(f"No utterances in: {path_to_file}, skipping it")
+            continue
 
         # run forward pass, evaluate and, print the metrics
-        raw_pred, raw_labels, _ = trainer.predict(eval_dataset)
+        if use_trainer:
+            raw_pred, raw_labels, _ = trainer.predict(eval_dataset)
+        else:
+            raw_pred, raw_labels = engine.predict_logits(
+                eval_dataset, batch_size=args.batch_size, prefetch=args.prefetch
+            )
         path_to_output_file = f"{output_folder}/{dataset_name}_metrics"
 
         metrics = compute_metrics(
             raw_pred, raw_labels, label_list=id2tag, log_folder=path_to_output_file
         )
 
+        # speed / accuracy of the early exits
+        if args.exit_thresholds is not None:
+            report = early_exit_report(
+                engine,
+                eval_dataset,
+                [float(t) for t in args.exit_thresholds.split()],
+                id2tag,
+                batch_size=args.batch_size,
+            )
+            print(report)
+            print(report, file=open(f"{output_folder}/{dataset_name}_early_exit", "w"))
+
 
 if __name__ == "__main__":
     args = parse_args()
@@ -24,6 +24,9 @@ dataset=uwb_atcc
 seed=1234
 output_dir=experiments/results/baseline
 
+# tokenized test sets, reused by the evaluations of other seeds
+cache_dir=experiments/tokenized_cache
+
 # with this we can parse options to this script
 . data/utils/parse_options.sh
 
@@ -52,6 +55,7 @@ fi
 $cmd python3 src/eval_diarization.py \
   --input-model "$output_folder/" \
   --batch-size $batch_size \
+  --cache-dir $cache_dir \
   --input-files "$input_files" --test-names "$test_names" \
   --output-folder $output_folder/evaluations
 
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: Copyright © <2022> Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Juan Zuluaga-Gomez <jzuluaga@idiap.ch>
+#
+# SPDX-License-Identifier: MIT-License
+
+"""
+    Script to export a text-based diarization model (output folder of
+    train_diarization.py) to ONNX, with dynamic batch and sequence axes.
+    The ONNX graph is stored next to the model, and it is used by
+    inference_diarization.py and eval_diarization.py with '--backend onnxruntime'.
+
+    After the export, the ONNX Runtime logits are compared to the PyTorch ones,
+    the script fails if they differ more than '--atol' or if any tag changes.
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import torch
+from transformers import AutoTokenizer, BertForTokenClassification
+
+from diarization_engine import ONNX_MODEL_NAME, LogitsOnly, OnnxTokenClassifier
+from diarization_utils import read_atc_diarization_data
+
+# used to check the exported model when no '--check-data' is given
+CHECK_SENTENCES = [
+    "lufthansa one two three contact praha radar one two seven decimal one two five good bye",
+    "descend flight level one zero zero lufthansa one two three",
+    "roger",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-m",
+        "--input-model",
+        required=True,
+        help="Folder where the final model is stored",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-folder",
+        default=None,
+        help="Folder where to store the ONNX model, default is the input model folder",
+    )
+    parser.add_argument(
+        "--opset", type=int, default=14, help="ONNX opset version used for exporting"
+    )
+    parser.add_argument(
+        "--check-data",
+        default=None,
+        help="utt2text_tags file used to compare the PyTorch and ONNX Runtime outputs",
+    )
+    parser.add_argument(
+        "--atol",
+        type=float,
+        default=1e-4,
+        help="Maximum absolute difference allowed between PyTorch and ONNX Runtime logits",
+    )
+
+    return parser.parse_args()
+
+
+def main(args):
+    """Main code execution"""
+
+    output_folder = (
+        args.output_folder if args.output_folder is not None else args.input_model
+    )
+    os.makedirs(output_folder, exist_ok=True)
+    path_to_onnx = os.path.join(output_folder, ONNX_MODEL_NAME)
+
+    model = BertForTokenClassification.from_pretrained(args.input_model).eval()
+    tokenizer = AutoTokenizer.from_pretrained(
+        args.input_model, use_fast=True, do_lower_case=True
+    )
+
+    # the model config and tokenizer are needed to load the model with onnxruntime
+    if output_folder != args.input_model:
+        model.config.save_pretrained(output_folder)
+        tokenizer.save_pretrained(output_folder)
+
+    # sentences to trace the graph and to check the outputs
+    if args.check_data is not None:
+        texts, _ = read_atc_diarization_data(args.check_data)
+    else:
+        texts = [sentence.split() for sentence in CHECK_SENTENCES]
+    encodings = tokenizer(
+        texts,
+        is_split_into_words=True,
+        padding="longest",
+        truncation=True,
+        return_tensors="pt",
+    )
+    inputs = (
+        encodings["input_ids"],
+        encodings["attention_mask"],
+        encodings["token_type_ids"],
+    )
+
+    print(f"Exporting the model to ONNX in: {path_to_onnx}")
+    dynamic_axes = {
+        name: {0: "batch", 1: "sequence"}
+        for name in ["input_ids", "attention_mask", "token_type_ids", "logits"]
+    }
+    torch.onnx.export(
+        LogitsOnly(model).eval(),
+        inputs,
+        path_to_onnx,
+        input_names=["input_ids", "attention_mask", "token_type_ids"],
+        output_names=["logits"],
+        dynamic_axes=dynamic_axes,
+        opset_version=args.opset,
+        do_constant_folding=True,
+    )
+
+    # compare the outputs of PyTorch and ONNX Runtime
+    with torch.inference_mode():
+        torch_logits = model(**encodings).logits.numpy()
+    onnx_logits = OnnxTokenClassifier(output_folder)(**encodings).logits.numpy()
+
+    mask = encodings["attention_mask"].numpy().astype(bool)
+    max_diff = np.abs(torch_logits - onnx_logits)[mask].max()
+    tags_mismatch = (torch_logits.argmax(-1) != onnx_logits.argmax(-1))[mask].sum()
+
+    print(f"Max. absolute difference in logits: {max_diff:.2e} (atol: {args.atol})")
+    print(f"Tokens with different tags: {tags_mismatch}")
+    if max_diff > args.atol or tags_mismatch > 0:
+        print("The ONNX model does not match the PyTorch model. Exit")
+        sys.exit(1)
+    print("Done. The ONNX model matches the PyTorch model")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
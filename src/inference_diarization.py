@@ -19,102 +19,72 @@ HuggingFace repository: https://huggingface.co/bert-base-uncased
 """
 
 import argparse
+import multiprocessing
 import os
+import time
+
+# the import time is part of the startup time report
+_import_start = time.perf_counter()
 
 import numpy as np
 import torch
-from transformers import BertForTokenClassification, BertTokenizerFast, pipeline
-
-from diarization_utils import clean_input_utterance
-
-
-def convert_to_utt2text_tags(predictions):
-    """convert the pipeline output of HuggingFace to text and tags"""
-
-    outputs = []
-    for prediction in predictions:
-        text_list = []
-        tags_list = []
-        for sample in prediction:
-            # extract data
-            entity = sample["entity_group"]
-
-            # get the transcript and fix normalization
-            word = sample["word"].rstrip()
-            word = word.replace("x - ray", "x-ray") if "x - ray" in word else word
-            word = word.replace(" ' ", "'") if "x - ray" in word else word
-            word = word.split()
 
-            # get the tags
-            tags = np.full(shape=len(word), fill_value="I-" + entity)
-            tags[0] = "B-" + entity
+from diarization_cache import CachedEngine, ResultCache, model_fingerprint
+from diarization_engine import DiarizationEngine
+from diarization_pipeline import run_pipeline
+from diarization_quantization import load_quantized_engine, quantize_engine
+from diarization_server import serve
+from diarization_utils import (
+    LineIndexedFile,
+    TokenBudgetBatchSampler,
+    clean_input_utterance,
+)
 
-            # append text and tags
-            text_list.append(word)
-            tags_list.append(tags)
-        # flatten the list
-        text_list = [x for xs in text_list for x in xs]
-        tags_list = [x for xs in tags_list for x in xs]
-        assert len(text_list) == len(tags_list), "text and tags list have differnt size"
+_import_time = time.perf_counter() - _import_start
 
-        # create the final object
-        outputs.append({"text": text_list, "tags": tags_list})
-
-    return outputs
+# number of lines read at once to get the lengths for --max-tokens
+LENGTH_CHUNK_SIZE = 10000
 
 
 class ATCDataset(torch.utils.data.Dataset):
     """\
     Dataset for Text-based Diarization of ATC data. We will classify
     whether each token of the ATC transcript is from Pilot or ATCO.
+
+    The file is memory-mapped and each line is parsed only when it is accessed
+    (see LineIndexedFile), so large files do not need to fit in memory.
+    Empty utterances return an empty sample, they are skipped when tagging.
     """
 
     def __init__(self, path_to_file):
+        self.lines = LineIndexedFile(path_to_file)
 
-        sequences = []
-        utt_id = []
-        encodings = []
-
-        with open(path_to_file, "r") as rd:
-            # check if using utt2text_tags, the transcript is on column 4
-            # otherwise is in column 2 [uttid text]
-            is_utt2text_tags = True if "utt2text_tags" in path_to_file else False
-
-            for line in rd:
-
-                if is_utt2text_tags:
-                    ids = line.split(";")[0].rstrip()
-                    # clean the input utterance
-                    sample = clean_input_utterance(line.split(";")[1].rstrip())
-                else:
-                    ids = line.split(" ")[0].rstrip()
-                    # clean the input utterance
-                    sample = clean_input_utterance(
-                        " ".join(line.split(" ")[1:]).rstrip()
-                    )
-
-                # continue if sample is empty
-                if sample == "" or sample == " ":
-                    continue
-
-                # append to output dictionaries
-                sequences.append(sample)
-                utt_id.append(ids)
-                encodings.append([ids, sample])
-
-        self.sequences = sequences
-        self.utt_id = utt_id
-        self.encodings = encodings
+        # check if using utt2text_tags, the transcript is on column 4
+        # otherwise is in column 2 [uttid text]
+        self.is_utt2text_tags = True if "utt2text_tags" in path_to_file else False
 
     def __getitem__(self, idx):
-        item = self.encodings[idx]
-        return item
+        line = self.lines[idx]
+
+        if self.is_utt2text_tags:
+            ids = line.split(";")[0].rstrip()
+            # clean the input utterance
+            sample = clean_input_utterance(line.split(";")[1].rstrip())
+        else:
+            ids = line.split(" ")[0].rstrip()
+            # clean the input utterance
+            sample = clean_input_utterance(" ".join(line.split(" ")[1:]).rstrip())
+
+        # the sample is empty (skipped) if it has no words
+        if sample == " ":
+            sample = ""
+        return [ids, sample]
 
     def __len__(self):
-        return len(self.sequences)
+        return len(self.lines)
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -124,6 +94,93 @@ def parse_args():
         default=1,
         help="Batch size you want to use for decoding",
     )
+    parser.add_argument(
+        "--backend",
+        choices=["pytorch", "onnxruntime", "torchscript"],
+        default="pytorch",
+        help="Run the model with PyTorch, with ONNX Runtime (CPU, needs the model exported with export_onnx.py) or traced with TorchScript (CPU, inputs padded to shape buckets)",
+    )
+    parser.add_argument(
+        "--cache-size-mb",
+        type=float,
+        default=0,
+        help="If > 0, cache the results of repeated utterances in memory (LRU) up to this size",
+    )
+    parser.add_argument(
+        "--cache-db",
+        default=None,
+        help="sqlite file where the cached results are stored, it persists across runs",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        help="If > 0, overlap tokenization, forward pass and writing in 3 threads, with queues of N batches",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes, each one processes a contiguous shard of the input files (CPU only)",
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=None,
+        help="Number of torch threads per worker process, default: number of CPUs / workers",
+    )
+    parser.add_argument(
+        "--quantize",
+        choices=["none", "int8"],
+        default="none",
+        help="Apply dynamic int8 quantization to the Linear layers of the model (CPU only, pytorch backend)",
+    )
+    parser.add_argument(
+        "--quantized-model",
+        default=None,
+        help="Path to the saved int8 model, it is loaded if present, otherwise created. Default: <input-model>/quantized_int8.pt",
+    )
+    parser.add_argument(
+        "--guard-data",
+        default=None,
+        help="Held-out utt2text_tags file to check the JER of a new int8 model before accepting it",
+    )
+    parser.add_argument(
+        "--max-jer-degradation",
+        type=float,
+        default=1.0,
+        help="Refuse the int8 model if its JER is worse than the float model JER plus this value (absolute, in %%)",
+    )
+    parser.add_argument(
+        "--aggregation",
+        choices=DiarizationEngine.AGGREGATIONS,
+        default="average",
+        help="How the subword scores of a word are reduced to the word score",
+    )
+    parser.add_argument(
+        "--window-size",
+        type=int,
+        default=0,
+        help="If > 0, split the utterances longer than N words in overlapping windows instead of truncating them",
+    )
+    parser.add_argument(
+        "--window-stride",
+        type=int,
+        default=None,
+        help="Number of words between the starts of two windows, default: window size / 2",
+    )
+    parser.add_argument(
+        "--exit-threshold",
+        type=float,
+        default=None,
+        help="(models trained with --early-exit-layers) Stop each batch at the first exit where all the tokens have a probability >= threshold",
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=0,
+        help="If > 0, group utterances of similar length in batches of at most N tokens (padding included), instead of using --batch-size",
+    )
 
     parser.add_argument(
         "-m",
@@ -134,28 +191,274 @@ def parse_args():
     parser.add_argument(
         "-i",
         "--input-files",
-        required=True,
         help="String with paths to text or utt2spk_id files to be evaluated, it needs to match the 'test_names' variables",
     )
     parser.add_argument(
         "-n",
         "--test-names",
-        required=True,
         help="Name of the test sets to be evaluated",
     )
 
     parser.add_argument(
-        "-o", "--output-folder", required=True, help="Folder where to store the outputs"
+        "-o", "--output-folder", help="Folder where to store the outputs"
+    )
+
+    # server mode, the model is loaded once and the requests are micro-batched
+    parser.add_argument(
+        "--serve",
+        default=None,
+        help="Run as a server on a socket instead of processing files, e.g., 'unix:/tmp/diarization.sock' or 'localhost:8765'",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=32,
+        help="(server mode) Maximum number of utterances in one micro-batch",
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=5.0,
+        help="(server mode) Maximum time an utterance waits for other requests before running its batch",
+    )
+
+    args = parser.parse_args(argv)
+    if args.quantize != "none" and args.backend != "pytorch":
+        parser.error("--quantize can only be used with the pytorch backend")
+    if args.serve is None and None in (
+        args.input_files,
+        args.test_names,
+        args.output_folder,
+    ):
+        parser.error(
+            "--input-files, --test-names and --output-folder are required (unless --serve is used)"
+        )
+    return args
+
+
+def tag_dataset(engine, dataset, batch_size=1, max_tokens=0, prefetch=0):
+    """Run inference on all the utterances of 'dataset'. Returns the output
+    lines (utt_id;text;tags) in the same order as the dataset, without the empty utterances.
+    If prefetch > 0, tokenization, forward pass and formatting of the outputs
+    run in three threads connected with queues of 'prefetch' batches
+    """
+
+    # either batches of similar length (token budget) or fixed size batches in file order
+    if max_tokens > 0:
+        # lengths from the subwords of each word (each word is tokenized once),
+        # by chunks: only the lengths of the whole file are kept. With windows,
+        # an utterance counts as its number of windows x longest window
+        lengths = np.zeros(len(dataset), dtype=np.int64)
+        sizes = np.zeros(len(dataset), dtype=np.int64)
+        for start in range(0, len(dataset), LENGTH_CHUNK_SIZE):
+            end = min(start + LENGTH_CHUNK_SIZE, len(dataset))
+            lengths[start:end], sizes[start:end] = engine.sequence_shapes(
+                [dataset[idx][1].split() for idx in range(start, end)]
+            )
+        batch_sampler = TokenBudgetBatchSampler(lengths, max_tokens, sizes=sizes)
+        print(
+            f"Token budget of {max_tokens}: {len(batch_sampler)} batches, "
+            f"padding ratio: {batch_sampler.padding_ratio():.3f}"
+        )
+    else:
+        batch_sampler = torch.utils.data.BatchSampler(
+            torch.utils.data.SequentialSampler(dataset),
+            batch_size=batch_size,
+            drop_last=False,
+        )
+    dataLoader_ATC = torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler)
+
+    # outputs are stored in the original order
+    output_lines = [None] * len(dataset)
+
+    def prepare(batch):
+        batch_indices, (utt_ids, samples) = batch
+        # skip the empty utterances
+        batch = [
+            (idx, ids, sample.split())
+            for idx, ids, sample in zip(batch_indices, utt_ids, samples)
+            if sample != ""
+        ]
+        if len(batch) == 0:
+            return [], [], None
+        batch_indices, utt_ids, batch_words = zip(*batch)
+        return batch_indices, utt_ids, engine.prepare(list(batch_words))
+
+    def forward(batch):
+        batch_indices, utt_ids, state = batch
+        if state is None:
+            return batch
+        return batch_indices, utt_ids, engine.run(state)
+
+    def write(batch):
+        batch_indices, utt_ids, state = batch
+        if state is None:
+            return
+        predictions = engine.finish(state)
+        for idx, ids, prediction in zip(batch_indices, utt_ids, predictions):
+            text = " ".join(prediction["text"])
+            tags = engine.format_tags(prediction["tag_ids"])
+            output_lines[idx] = f"{ids};{text};{tags}"
+
+    batches = zip(batch_sampler, dataLoader_ATC)
+    if prefetch > 0:
+        stats = run_pipeline(batches, prepare, forward, write, queue_size=prefetch)
+        print("\n".join(map(str, stats)))
+    else:
+        for batch in batches:
+            write(forward(prepare(batch)))
+
+    return [line for line in output_lines if line is not None]
+
+
+# engine and dataset shared with the forked worker processes (copy-on-write)
+_worker_engine, _worker_dataset = None, None
+
+
+def _tag_shard(start, end, batch_size, max_tokens, prefetch):
+    """Run inference on a contiguous range of the shared dataset (worker process)"""
+    shard = torch.utils.data.Subset(_worker_dataset, range(start, end))
+    output_lines = tag_dataset(
+        _worker_engine,
+        shard,
+        batch_size=batch_size,
+        max_tokens=max_tokens,
+        prefetch=prefetch,
+    )
+
+    # the cache and early exit statistics of the worker are sent back to the main process
+    depth_stats = (_worker_engine.depth_sum, _worker_engine.depth_samples)
+    cache = getattr(_worker_engine, "cache", None)
+    if cache is None:
+        return output_lines, None, depth_stats
+    cache.flush()
+    return output_lines, (cache.hits, cache.misses), depth_stats
+
+
+def tag_dataset_parallel(
+    engine,
+    dataset,
+    workers,
+    threads_per_worker=None,
+    batch_size=1,
+    max_tokens=0,
+    prefetch=0,
+):
+    """Same as 'tag_dataset', but the dataset is split in contiguous shards that
+    are processed by forked worker processes. The model weights are shared
+    copy-on-write with the workers, and the outputs are merged in order.
+    """
+    global _worker_engine, _worker_dataset
+
+    if engine.device.type != "cpu":
+        raise ValueError("--workers can only be used when running on CPU")
+    if threads_per_worker is None:
+        threads_per_worker = max(1, os.cpu_count() // workers)
+
+    if len(dataset) == 0:
+        return []
+    shard_size = -(-len(dataset) // workers)
+    shards = [
+        (start, min(start + shard_size, len(dataset)), batch_size, max_tokens, prefetch)
+        for start in range(0, len(dataset), shard_size)
+    ]
+
+    _worker_engine, _worker_dataset = engine, dataset
+    context = multiprocessing.get_context("fork")
+    with context.Pool(
+        len(shards), initializer=torch.set_num_threads, initargs=(threads_per_worker,)
+    ) as pool:
+        outputs = pool.starmap(_tag_shard, shards)
+    _worker_engine, _worker_dataset = None, None
+
+    for _, cache_stats, depth_stats in outputs:
+        if cache_stats is not None:
+            engine.cache.hits += cache_stats[0]
+            engine.cache.misses += cache_stats[1]
+        engine.add_depth_stats(*depth_stats)
+
+    return [line for shard_output, _, _ in outputs for line in shard_output]
+
+
+def load_engine(args):
+    """Build the inference engine, with the int8 model if '--quantize int8' is set.
+    It prints the breakdown of the startup time
+    """
+    engine_options = dict(
+        aggregation=args.aggregation,
+        window_size=args.window_size,
+        window_stride=args.window_stride,
+        exit_threshold=args.exit_threshold,
+    )
+
+    # an int8 model already accepted for this float model is loaded directly
+    engine = None
+    if args.quantize == "int8":
+        engine = load_quantized_engine(
+            args.input_model, args.quantized_model, **engine_options
+        )
+
+    if engine is not None:
+        startup_times = {"imports": _import_time, **engine.startup_times}
+    else:
+        engine = DiarizationEngine.from_pretrained(
+            args.input_model, backend=args.backend, **engine_options
+        )
+        startup_times = {"imports": _import_time, **engine.startup_times}
+
+        if args.quantize == "int8":
+            start = time.perf_counter()
+            engine = quantize_engine(
+                engine,
+                args.input_model,
+                guard_data=args.guard_data,
+                max_jer_degradation=args.max_jer_degradation,
+                path_to_quantized=args.quantized_model,
+            )
+            startup_times["quantization"] = time.perf_counter() - start
+
+    # first forward pass (lazy initialization of torch and of the weights)
+    start = time.perf_counter()
+    engine.predict([["roger"]])
+    startup_times["first forward"] = time.perf_counter() - start
+    print(
+        "Startup time: "
+        + " | ".join(f"{name} {value:.3f} s" for name, value in startup_times.items())
     )
 
-    return parser.parse_args()
+    # look up the results of repeated utterances in a cache before the forward pass
+    if args.cache_size_mb > 0 or args.cache_db is not None:
+        fingerprint = model_fingerprint(
+            args.input_model,
+            args.backend,
+            args.quantize,
+            args.aggregation,
+            engine.window_size,
+            engine.window_stride,
+            engine.exit_threshold,
+        )
+        cache = ResultCache(
+            fingerprint,
+            max_bytes=int(args.cache_size_mb * 1024**2),
+            path_to_db=args.cache_db,
+        )
+        engine = CachedEngine(engine, cache)
+    return engine
 
 
 def main(args):
     """Main code execution"""
 
+    if args.serve is not None:
+        engine = load_engine(args)
+        return serve(
+            engine,
+            args.serve,
+            max_batch_size=args.max_batch_size,
+            max_wait_ms=args.max_wait_ms,
+        )
+
     # input model and some detailed outputs
-    token_classification_model = args.input_model
     path_to_files = args.input_files.rstrip().split(" ")
     test_set_names = args.test_names.rstrip().split(" ")
     output_folder = args.output_folder
@@ -170,18 +473,8 @@ def main(args):
 
     print("\nLoading the sequence classification recognition model (text-based Diarization)\n")
 
-    # Fetch the Model and tokenizer
-    eval_model = BertForTokenClassification.from_pretrained(token_classification_model)
-    tokenizer = BertTokenizerFast.from_pretrained("bert-base-uncased")
-
-    # Pipeline for sequence classification
-    seq_cla = pipeline(
-        "token-classification",
-        model=eval_model,
-        tokenizer=tokenizer,
-        aggregation_strategy="average",
-        ignore_labels=["O"],
-    )
+    # Fetch the Model and tokenizer, and build the batched inference engine
+    engine = load_engine(args)
 
     # main loop,
     for path_to_file, dataset_name in zip(path_to_files, test_set_names):
@@ -191,23 +484,35 @@ def main(args):
 
         # create the dataset and DataLoader objects
         test_dataset = ATCDataset(path_to_file)
-        dataLoader_ATC = torch.utils.data.DataLoader(
-            test_dataset, batch_size=args.batch_size, shuffle=False
-        )
 
-        inference_out, utt_ids_out = [], []
-        # run inference on the whole database
-        for local_batch in dataLoader_ATC:
-            utt_ids_out += local_batch[0]
-            inference = seq_cla(list(local_batch[1]), batch_size=args.batch_size)
-            inference_out += convert_to_utt2text_tags(inference)
-
-        # join the predictions
-        output_dict = []
-        for ids, predictions in zip(utt_ids_out, inference_out):
-            text = " ".join(predictions["text"])
-            tags = ",".join(predictions["tags"])
-            output_dict.append(f"{ids};{text};{tags}")
+        # run inference on the whole database, in one or several processes
+        if args.workers > 1:
+            output_dict = tag_dataset_parallel(
+                engine,
+                test_dataset,
+                workers=args.workers,
+                threads_per_worker=args.threads_per_worker,
+                batch_size=args.batch_size,
+                max_tokens=args.max_tokens,
+                prefetch=args.prefetch,
+            )
+        else:
+            output_dict = tag_dataset(
+                engine,
+                test_dataset,
+                batch_size=args.batch_size,
+                max_tokens=args.max_tokens,
+                prefetch=args.prefetch,
+            )
+
+        if args.exit_threshold is not None:
+            print(f"Average number of layers (early exit): {engine.average_depth():.2f}")
+            engine.reset_depth_stats()
+
+        if isinstance(engine, CachedEngine):
+            engine.cache.flush()
+            print(engine.cache.report())
+            engine.cache.reset_stats()
 
         # print the results in a txt file
         path_to_output_file = f"{output_folder}/{dataset_name}_inference"
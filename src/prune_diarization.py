@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: Copyright © <2022> Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Juan Zuluaga-Gomez <jzuluaga@idiap.ch>
+#
+# SPDX-License-Identifier: MIT-License
+
+"""
+    Script to prune the attention heads and the FFN neurons of a fine-tuned
+    text-based diarization model (output folder of train_diarization.py):
+        1. the importance of each head and neuron is estimated on a validation
+           utt2text_tags file, with the gradient of the loss w.r.t. a mask on them
+        2. the least important ones are removed, keeping '--compute-budget' of the
+           heads (at least one per layer) and of the FFN neurons of each layer
+        3. optionally, the pruned model is fine-tuned for a few steps (recovery)
+
+    The pruned model is saved with the standard save_pretrained (the pruned heads
+    and the new intermediate size are in the config), so it loads with from_pretrained.
+    The speed and JER of the pruned model are reported against the unpruned model.
+"""
+
+import argparse
+import os
+import time
+
+import torch
+from transformers import (
+    AutoModelForTokenClassification,
+    AutoTokenizer,
+    DataCollatorForTokenClassification,
+    Trainer,
+    TrainingArguments,
+)
+from transformers.pytorch_utils import prune_linear_layer
+
+from diarization_engine import DiarizationEngine
+from diarization_utils import compute_jer, load_diarization_dataset
+
+
+def compute_importance(model, dataset, batch_size=16):
+    """Importance of each attention head (layers, heads) and FFN neuron
+    (layers, intermediate size): accumulated absolute value of the gradient of
+    the loss w.r.t. a mask on its output (Michel et al., 2019)
+    """
+    config = model.config
+    model.eval()
+    head_mask = torch.ones(
+        config.num_hidden_layers, config.num_attention_heads, requires_grad=True
+    )
+    head_importance = torch.zeros_like(head_mask)
+    neuron_importance = torch.zeros(config.num_hidden_layers, config.intermediate_size)
+
+    # keep the output of the FFN intermediate layers to get their gradient
+    activations = {}
+
+    def keep_activation(idx):
+        def hook(module, inputs, output):
+            output.retain_grad()
+            activations[idx] = output
+
+        return hook
+
+    hooks = [
+        layer.intermediate.register_forward_hook(keep_activation(idx))
+        for idx, layer in enumerate(model.bert.encoder.layer)
+    ]
+
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size)
+    for batch in dataloader:
+        loss = model(**batch, head_mask=head_mask).loss
+        loss.backward()
+
+        head_importance += head_mask.grad.abs()
+        head_mask.grad = None
+        for idx, output in activations.items():
+            neuron_importance[idx] += (output * output.grad).abs().sum(dim=(0, 1))
+        model.zero_grad()
+
+    for hook in hooks:
+        hook.remove()
+
+    # normalize the head importance per layer (Michel et al., 2019)
+    head_importance /= head_importance.norm(dim=-1, keepdim=True) + 1e-20
+    return head_importance.detach(), neuron_importance
+
+
+def prune_model(model, head_importance, neuron_importance, compute_budget):
+    """Remove the least important heads (globally ranked, at least one per layer)
+    and the least important FFN neurons (same number in each layer)
+    """
+    nb_layers, nb_heads = head_importance.shape
+    nb_keep_heads = max(nb_layers, round(nb_layers * nb_heads * compute_budget))
+
+    # the most important head of each layer is always kept
+    keep = torch.zeros_like(head_importance, dtype=torch.bool)
+    keep[torch.arange(nb_layers), head_importance.argmax(dim=-1)] = True
+    order = torch.argsort(head_importance.flatten(), descending=True)
+    for flat_idx in order.tolist():
+        if keep.sum() >= nb_keep_heads:
+            break
+        keep.view(-1)[flat_idx] = True
+
+    heads_to_prune = {
+        layer: torch.nonzero(~keep[layer]).flatten().tolist()
+        for layer in range(nb_layers)
+        if (~keep[layer]).any()
+    }
+    model.prune_heads(heads_to_prune)
+
+    # FFN neurons, the intermediate size must be the same in all the layers
+    nb_keep_neurons = max(1, round(neuron_importance.shape[1] * compute_budget))
+    for idx, layer in enumerate(model.bert.encoder.layer):
+        index = torch.argsort(neuron_importance[idx], descending=True)[:nb_keep_neurons]
+        index = index.sort().values
+        layer.intermediate.dense = prune_linear_layer(layer.intermediate.dense, index, dim=0)
+        layer.output.dense = prune_linear_layer(layer.output.dense, index, dim=1)
+    model.config.intermediate_size = nb_keep_neurons
+    return model
+
+
+def evaluate_model(model, tokenizer, dataset, id2tag, batch_size=16):
+    """Number of parameters, inference time (CPU) and JER of a model"""
+    engine = DiarizationEngine(model, tokenizer, device="cpu")
+    engine.predict_logits(dataset, batch_size=batch_size)  # warm-up
+
+    start = time.perf_counter()
+    raw_pred, raw_labels = engine.predict_logits(dataset, batch_size=batch_size)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "parameters": sum(p.numel() for p in model.parameters()),
+        "time": elapsed,
+        "jer": compute_jer(raw_pred, raw_labels, id2tag),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-m",
+        "--input-model",
+        required=True,
+        help="Folder where the fine-tuned model is stored",
+    )
+    parser.add_argument(
+        "--val-data",
+        required=True,
+        help="Validation file (utt2text_tags) used to score the heads and neurons, and to report the JER",
+    )
+    parser.add_argument(
+        "--compute-budget",
+        type=float,
+        default=0.5,
+        help="Fraction of the attention heads and of the FFN neurons that are kept",
+    )
+    parser.add_argument(
+        "-b", "--batch-size", type=int, default=16, help="Batch size for scoring and evaluation"
+    )
+
+    # recovery fine-tuning
+    parser.add_argument(
+        "--train-data",
+        default=None,
+        help="Train file (utt2text_tags) for the recovery fine-tuning",
+    )
+    parser.add_argument(
+        "--recovery-steps",
+        type=int,
+        default=0,
+        help="If > 0, fine-tune the pruned model for N steps on --train-data",
+    )
+    parser.add_argument(
+        "--learning-rate",
+        type=float,
+        default=5e-5,
+        help="Learning rate of the recovery fine-tuning",
+    )
+    parser.add_argument(
+        "-s", "--seed", type=int, default=1234, help="Seed for the recovery fine-tuning"
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output-folder",
+        required=True,
+        help="Folder where to store the pruned model",
+    )
+
+    args = parser.parse_args()
+    if args.recovery_steps > 0 and args.train_data is None:
+        parser.error("--recovery-steps needs --train-data")
+    return args
+
+
+def main(args):
+    """Main code execution"""
+
+    model = AutoModelForTokenClassification.from_pretrained(args.input_model)
+    tokenizer = AutoTokenizer.from_pretrained(
+        args.input_model, use_fast=True, do_lower_case=True
+    )
+    tag2id = model.config.label2id
+    id2tag = {int(k): v for k, v in model.config.id2label.items()}
+
+    val_dataset = load_diarization_dataset(args.val_data, tokenizer, tag2id)
+
+    print("Evaluating the unpruned model")
+    unpruned = evaluate_model(model, tokenizer, val_dataset, id2tag, args.batch_size)
+
+    print("Scoring the attention heads and the FFN neurons")
+    head_importance, neuron_importance = compute_importance(
+        model, val_dataset, batch_size=args.batch_size
+    )
+    model = prune_model(model, head_importance, neuron_importance, args.compute_budget)
+
+    if args.recovery_steps > 0:
+        print(f"Recovery fine-tuning for {args.recovery_steps} steps")
+        train_dataset = load_diarization_dataset(args.train_data, tokenizer, tag2id)
+        training_args = TrainingArguments(
+            output_dir=args.output_folder,
+            per_device_train_batch_size=args.batch_size,
+            learning_rate=args.learning_rate,
+            max_steps=args.recovery_steps,
+            warmup_steps=args.recovery_steps // 10,
+            weight_decay=0.001,
+            logging_dir=args.output_folder + "/logs",
+            save_strategy="no",
+            report_to=[],
+            seed=args.seed,
+        )
+        trainer = Trainer(
+            model=model,
+            args=training_args,
+            train_dataset=train_dataset,
+            data_collator=DataCollatorForTokenClassification(tokenizer),
+        )
+        trainer.train()
+
+    print("Evaluating the pruned model")
+    pruned = evaluate_model(model, tokenizer, val_dataset, id2tag, args.batch_size)
+
+    os.makedirs(args.output_folder, exist_ok=True)
+    model.save_pretrained(args.output_folder)
+    tokenizer.save_pretrained(args.output_folder)
+
+    nb_heads = model.config.num_hidden_layers * model.config.num_attention_heads
+    nb_pruned = sum(len(heads) for heads in model.config.pruned_heads.values())
+    report = "\n".join(
+        [
+            f"Heads kept: {nb_heads - nb_pruned}/{nb_heads}, FFN size: {model.config.intermediate_size}",
+            f"{'model':>8} | {'params (M)':>10} | {'time (s)':>8} | {'JER (%)':>7}",
+        ]
+        + [
+            f"{name:>8} | {m['parameters'] / 1e6:10.2f} | {m['time']:8.3f} | {m['jer']:7.2f}"
+            for name, m in [("unpruned", unpruned), ("pruned", pruned)]
+        ]
+    )
+    print(report)
+    print(report, file=open(f"{args.output_folder}/pruning_report", "w"))
+    print(f"Done. Pruned model in: {args.output_folder}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -17,6 +17,10 @@ DATA=experiments/data
 
 # model related vars
 batch_size=10
+# if > 0, batches are built with utterances of similar length up to max_tokens
+max_tokens=0
+# number of worker processes (CPU only), each one tags a shard of the input files
+workers=1
 
 # vars of the model and input/output folder
 input_model=bert-base-uncased
@@ -52,6 +56,8 @@ mkdir -p $output_folder/inference
 $cmd python3 src/inference_diarization.py \
   --input-model "$output_folder/" \
   --batch-size $batch_size \
+  --max-tokens $max_tokens \
+  --workers $workers \
   --input-files "$input_files" --test-names "$test_names" \
   --output-folder $output_folder/inference
 
@@ -17,7 +17,11 @@
 """
 
 import argparse
+import json
 import logging
+import multiprocessing
+import multiprocessing.connection
+import os
 import random
 import sys
 
@@ -25,39 +29,65 @@ import datasets
 import numpy as np
 import torch
 import transformers
-from datasets import load_metric
 
 # importing all utils functions for ATC datasets
 from sklearn.model_selection import train_test_split
 from transformers import (
+    AutoConfig,
     AutoModelForTokenClassification,
     AutoTokenizer,
     DataCollatorForTokenClassification,
+    EarlyStoppingCallback,
     Trainer,
     TrainingArguments,
     set_seed,
 )
+from transformers.trainer_pt_utils import LengthGroupedSampler
 
+from diarization_callbacks import SparseEvaluationCallback
+from diarization_metrics import DiarizationMetrics
+from diarization_models import BertForEarlyExitTokenClassification
 from diarization_utils import (
     ATCDataset_diarization,
+    AugmentedATCDataset_diarization,
+    LazyATCDataset_diarization,
     compute_metrics,
     encode_tags,
+    get_sequence_lengths,
+    load_diarization_dataset,
+    padding_ratio,
     read_atc_diarization_data,
+    read_atc_diarization_tags,
 )
 
 logger = logging.getLogger(__name__)
 
-# getting the device (CPU/GPU)
-if torch.cuda.is_available():
-    device = torch.device("cuda")
-    print(f"There are {torch.cuda.device_count()} GPU(s) available.")
-    print("Device name:", torch.cuda.get_device_name(0))
-else:
-    print("No GPU available, using the CPU instead.")
-    device = -1
 
+class LengthGroupedTrainer(Trainer):
+    """\
+    Trainer that groups the batches by length with the lengths already computed
+    ('train_lengths'), instead of reading all the training samples again
+    """
 
-def parse_args():
+    def __init__(self, *args, train_lengths=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.train_lengths = train_lengths
+
+    def _get_train_sampler(self):
+        if (
+            self.args.group_by_length
+            and self.args.world_size <= 1
+            and self.train_lengths is not None
+            and len(self.train_lengths) == len(self.train_dataset)
+        ):
+            return LengthGroupedSampler(
+                self.args.train_batch_size * self.args.gradient_accumulation_steps,
+                lengths=self.train_lengths,
+            )
+        return super()._get_train_sampler()
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
 
     # reporting vars
@@ -103,6 +133,24 @@ def parse_args():
     parser.add_argument(
         "--eval-steps", type=int, default=500, help="Perform evaluation each N steps"
     )
+    parser.add_argument(
+        "--early-stopping-patience",
+        type=int,
+        default=0,
+        help="If > 0, stop training when the validation metric does not improve in N evaluations. The model is then saved only when the metric improves",
+    )
+    parser.add_argument(
+        "--metric-for-best-model",
+        choices=["f1", "precision", "recall", "accuracy", "jer"],
+        default="f1",
+        help="Validation metric used for early stopping and to keep the best model",
+    )
+    parser.add_argument(
+        "--max-eval-interval",
+        type=int,
+        default=8,
+        help="With early stopping, the interval between evaluations doubles while the metric does not improve, up to N x eval steps",
+    )
     parser.add_argument(
         "--max-steps",
         type=int,
@@ -130,6 +178,57 @@ def parse_args():
         "--test-data", default=None, help="Test file for the token classification model (utt2text_tags)"
     )
 
+    parser.add_argument(
+        "--early-exit-layers",
+        default=None,
+        help="String with the (1-based) layers that get an extra classification head for early exit, e.g., '4 8'",
+    )
+    parser.add_argument(
+        "--no-group-by-length",
+        action="store_true",
+        help="Do not group the training samples of similar length in the batches (shuffle them all)",
+    )
+    parser.add_argument(
+        "--lazy-data",
+        action="store_true",
+        help="Memory-map the data files and tokenize each sample when it is used, for large files (needs --val-data)",
+    )
+
+    parser.add_argument(
+        "--augmentation-samples",
+        type=int,
+        default=0,
+        help="If > 0, add N new samples per epoch, made of random ATCO/pilot turns of the training samples (on the fly, see AugmentedATCDataset_diarization)",
+    )
+    parser.add_argument(
+        "--seeds",
+        default=None,
+        help="String with several seeds, e.g., '1 2 3 4 5'. The data is tokenized once and the seeds are trained in parallel processes, in <output_folder>/<seed>",
+    )
+    parser.add_argument(
+        "--parallel-seeds",
+        type=int,
+        default=None,
+        help="With --seeds, number of seeds trained at the same time, default: all",
+    )
+    parser.add_argument(
+        "--cpu-cores",
+        type=int,
+        default=None,
+        help="With --seeds, number of CPU cores shared by the seeds trained at the same time, default: all the available cores",
+    )
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        default=None,
+        help="Number of CPU threads used by PyTorch, default: PyTorch default",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Folder where the tokenized data is stored, the runs with the same data files and tokenizer reuse it",
+    )
+
     parser.add_argument(
         "train_data",
         help="Train file used for training a text-based diarization system (utt2text_tags)",
@@ -138,12 +237,238 @@ def parse_args():
         "output_folder",
         help="name of the output folder to store the token classification model and tokenizer",
     )
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.lazy_data and not args.val_data:
+        parser.error("--lazy-data needs a validation file (--val-data)")
+    return args
+
+
+def prepare_datasets(args, tokenizer):
+    """Read (or load from the cache) and tokenize the train, validation and test
+    sets. Returns the three datasets and tag2id
+    """
+    logger.info("*** Loading and preparing training and validation data ***")
+
+    if args.lazy_data:
+        # only the tags are read here, the samples are tokenized when they are used
+        logger.info("*** Using memory-mapped train/val data (lazy tokenization) ***")
+        unique_tags = read_atc_diarization_tags(
+            args.train_data
+        ) | read_atc_diarization_tags(args.val_data)
+        logger.info(f"*** There are {len(unique_tags)} unique tags ***")
+
+        unique_tags.add("O")
+        tag2id = {tag: id for id, tag in enumerate(sorted(unique_tags))}
+
+        train_dataset = LazyATCDataset_diarization(args.train_data, tokenizer, tag2id)
+        val_dataset = LazyATCDataset_diarization(args.val_data, tokenizer, tag2id)
+    elif args.cache_dir is not None:
+        # tokenized once and stored by columns, the other runs (e.g., seeds) with
+        # the same files and tokenizer memory-map them
+        logger.info(f"*** Using the tokenized data cache: {args.cache_dir} ***")
+        data_files = [args.train_data] + ([args.val_data] if args.val_data else [])
+        unique_tags = set.union(*map(read_atc_diarization_tags, data_files))
+        logger.info(f"*** There are {len(unique_tags)} unique tags ***")
+
+        unique_tags.add("O")
+        tag2id = {tag: id for id, tag in enumerate(sorted(unique_tags))}
+
+        train_dataset = load_diarization_dataset(
+            args.train_data, tokenizer, tag2id, padding=False, cache_dir=args.cache_dir
+        )
+        if args.val_data:
+            val_dataset = load_diarization_dataset(
+                args.val_data, tokenizer, tag2id, padding=False, cache_dir=args.cache_dir
+            )
+        else:
+            logger.info(
+                "*** You did not give validation data, splitting it in train/dev from train ***"
+            )
+            percentage = (
+                0.1 if len(train_dataset) < 100000 else 5000 / len(train_dataset)
+            )
+            train_indices, val_indices = train_test_split(
+                list(range(len(train_dataset))), test_size=percentage
+            )
+            val_dataset = torch.utils.data.Subset(train_dataset, val_indices)
+            train_dataset = torch.utils.data.Subset(train_dataset, train_indices)
+    else:
+        # split the train data in case there is not val data available
+        if args.val_data == "" or args.val_data == None:
+            logger.info(
+                "*** You did not give validation data, splitting it in train/dev from train ***"
+            )
+            train_texts, train_tags = read_atc_diarization_data(args.train_data)
+
+            # getting max number of samples in the val set:
+            percentage = 0.1 if len(train_texts) < 100000 else 5000 / len(train_texts)
+            train_texts, val_texts, train_tags, val_tags = train_test_split(
+                train_texts, train_tags, test_size=percentage
+            )
+        else:
+            logger.info("*** Using the validation data file ***")
+            train_texts, train_tags = read_atc_diarization_data(args.train_data)
+            val_texts, val_tags = read_atc_diarization_data(args.val_data)
+
+        # create sets with the tags, this will be added into the end model to
+        # perform inference (and know which tags correspond to what),
+        unique_tags_train = set(tag for doc in train_tags for tag in doc)
+        unique_tags_val = set(tag for doc in val_tags for tag in doc)
+        unique_tags = unique_tags_train | unique_tags_val
+        logger.info(f"*** There are {len(unique_tags)} unique tags ***")
+
+        # we need to add the 'O' label in tag2id: standard in NER systems
+        unique_tags.add("O")
+        # get the tag2id (sorted, the same ids in all the runs)
+        tag2id = {tag: id for id, tag in enumerate(sorted(unique_tags))}
+
+        # Tokenize text and generate encodings, without padding: the batches are
+        # padded to their longest sample by DataCollatorForTokenClassification
+        logger.info("*** Tokenizing the train/val sets ***")
+        train_encodings = tokenizer(
+            train_texts,
+            is_split_into_words=True,
+            return_offsets_mapping=True,
+            truncation=True,
+        )
+        val_encodings = tokenizer(
+            val_texts,
+            is_split_into_words=True,
+            return_offsets_mapping=True,
+            truncation=True,
+        )
+
+        train_labels = encode_tags(tag2id, train_tags, train_encodings)
+        val_labels = encode_tags(tag2id, val_tags, val_encodings)
+
+        # Last before training, generate train/val datasets
+        train_encodings.pop("offset_mapping")  # we don't want to pass this to the model
+        val_encodings.pop("offset_mapping")
+
+        # generate the datasets generators
+        train_dataset = ATCDataset_diarization(train_encodings, train_labels)
+        val_dataset = ATCDataset_diarization(val_encodings, val_labels)
+
+    # either, prepare the test set passed or use validation as 'final' test set
+    if args.test_data is not None and args.lazy_data:
+        test_dataset = LazyATCDataset_diarization(args.test_data, tokenizer, tag2id)
+    elif args.test_data is not None and args.cache_dir is not None:
+        test_dataset = load_diarization_dataset(
+            args.test_data, tokenizer, tag2id, padding=False, cache_dir=args.cache_dir
+        )
+    elif args.test_data is not None:
+        test_texts, test_tags = read_atc_diarization_data(args.test_data)
+        test_encodings = tokenizer(
+            test_texts,
+            is_split_into_words=True,
+            return_offsets_mapping=True,
+            truncation=True,
+        )
+
+        test_labels = encode_tags(tag2id, test_tags, test_encodings)
+        test_encodings.pop("offset_mapping")  # we don't want to pass this to the model
+        test_dataset = ATCDataset_diarization(test_encodings, test_labels)
+    else:
+        test_dataset = val_dataset
+
+    return train_dataset, val_dataset, test_dataset, tag2id
+
+
+def train_seed(args):
+    """Train one seed of --seeds (in a new process)"""
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    main(args)
+
+
+def run_seeds(args, tokenizer):
+    """Train the seeds of --seeds in parallel processes, sharing the tokenized
+    data (cache), and write the mean/std of their test metrics
+    """
+    seeds = [int(seed) for seed in args.seeds.split()]
+    os.makedirs(args.output_folder, exist_ok=True)
+    if not args.lazy_data and args.cache_dir is None:
+        args.cache_dir = os.path.join(args.output_folder, "tokenized_cache")
+
+    # tokenize once, the processes of the seeds memory-map the cache
+    logger.info(f"*** Preparing the data once for the seeds: {seeds} ***")
+    prepare_datasets(args, tokenizer)
+
+    # the cores are split between the seeds trained at the same time
+    if args.cpu_cores is not None:
+        cpu_cores = args.cpu_cores
+    elif hasattr(os, "sched_getaffinity"):
+        cpu_cores = len(os.sched_getaffinity(0))
+    else:
+        cpu_cores = os.cpu_count()
+    nb_parallel = min(len(seeds), args.parallel_seeds or len(seeds))
+    nb_threads = max(1, cpu_cores // nb_parallel)
+    logger.info(
+        f"*** Training {nb_parallel} seed(s) at the same time, {nb_threads} thread(s) each ***"
+    )
+
+    pending = [
+        argparse.Namespace(
+            **{
+                **vars(args),
+                "seed": seed,
+                "seeds": None,
+                "num_threads": nb_threads,
+                "output_folder": os.path.join(args.output_folder, str(seed)),
+            }
+        )
+        for seed in seeds
+    ]
+    context = multiprocessing.get_context("spawn")
+    running, failed = {}, []
+    while pending or running:
+        while pending and len(running) < nb_parallel:
+            seed_args = pending.pop(0)
+            process = context.Process(target=train_seed, args=(seed_args,))
+            process.start()
+            running[process] = seed_args.seed
+        multiprocessing.connection.wait([process.sentinel for process in running])
+        for process in [process for process in running if not process.is_alive()]:
+            process.join()
+            seed = running.pop(process)
+            if process.exitcode != 0:
+                logger.error(f"*** Seed {seed} failed (exit code {process.exitcode}) ***")
+                failed.append(seed)
+
+    # mean/std of the test metrics of the seeds
+    results = {}
+    for seed in seeds:
+        path_to_results = os.path.join(args.output_folder, str(seed), "test_results.json")
+        if seed not in failed and os.path.isfile(path_to_results):
+            with open(path_to_results, "r") as rd:
+                results[seed] = json.load(rd)
+    names = sorted({name for metrics in results.values() for name in metrics})
+    summary = {
+        name: {
+            "mean": float(np.mean([metrics[name] for metrics in results.values()])),
+            "std": float(np.std([metrics[name] for metrics in results.values()])),
+        }
+        for name in names
+    }
+    report = "\n".join(
+        [f"Seeds: {sorted(results)}, failed: {failed}"]
+        + [f"{name:>15}: {v['mean']:.4f} +- {v['std']:.4f}" for name, v in summary.items()]
+    )
+    logger.info(f"*** Results of the seeds ***\n{report}")
+    print(report, file=open(os.path.join(args.output_folder, "seeds_report"), "w"))
+    with open(os.path.join(args.output_folder, "seeds_results.json"), "w") as wr:
+        json.dump({"seeds": results, "summary": summary}, wr, indent=2)
 
 
 def main(args):
     """Main code execution"""
 
+    # getting the device (CPU/GPU)
+    if torch.cuda.is_available():
+        print(f"There are {torch.cuda.device_count()} GPU(s) available.")
+        print("Device name:", torch.cuda.get_device_name(0))
+    else:
+        print("No GPU available, using the CPU instead.")
+
     # Setup logging (following HuggingFace style)
     logging.basicConfig(
         format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
@@ -158,6 +483,9 @@ def main(args):
     transformers.utils.logging.enable_default_handler()
     transformers.utils.logging.enable_explicit_format()
 
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
     # first, set all the seeds:
     torch.manual_seed(args.seed)
     torch.cuda.manual_seed(args.seed)
@@ -178,67 +506,15 @@ def main(args):
         model_name, use_fast=True, do_lower_case=True
     )
 
-    # read train and validation data
-    logger.info("*** Loading and preparing training and validation data ***")
+    if args.seeds is not None:
+        run_seeds(args, tokenizer)
+        return
 
     # read train and validation data
-    # split the train data in case there is not val data available
-    if args.val_data == "" or args.val_data == None:
-        logger.info(
-            "*** You did not give validation data, splitting it in train/dev from train ***"
-        )
-        train_texts, train_tags = read_atc_diarization_data(args.train_data)
-
-        # getting max number of samples in the val set:
-        percentage = 0.1 if len(train_texts) < 100000 else 5000 / len(train_texts)
-        train_texts, val_texts, train_tags, val_tags = train_test_split(
-            train_texts, train_tags, test_size=percentage
-        )
-    else:
-        logger.info("*** Using the validation data file ***")
-        train_texts, train_tags = read_atc_diarization_data(args.train_data)
-        val_texts, val_tags = read_atc_diarization_data(args.val_data)
-
-    # create sets with the tags, this will be added into the end model to
-    # perform inference (and know which tags correspond to what),
-    unique_tags_train = set(tag for doc in train_tags for tag in doc)
-    unique_tags_val = set(tag for doc in val_tags for tag in doc)
-    unique_tags = unique_tags_train | unique_tags_val
-    logger.info(f"*** There are {len(unique_tags)} unique tags ***")
-
-    # we need to add the 'O' label in tag2id: standard in NER systems
-    unique_tags.add("O")
-    # get the tag2id and id2tag
-    tag2id = {tag: id for id, tag in enumerate(unique_tags)}
-    id2tag = {id: tag for tag, id in tag2id.items()}
-
-    # Tokenize text and generate encodings
-    logger.info("*** Tokenizing the train/val sets ***")
-    train_encodings = tokenizer(
-        train_texts,
-        is_split_into_words=True,
-        return_offsets_mapping=True,
-        padding=True,
-        truncation=True,
+    train_dataset, val_dataset, test_dataset, tag2id = prepare_datasets(
+        args, tokenizer
     )
-    val_encodings = tokenizer(
-        val_texts,
-        is_split_into_words=True,
-        return_offsets_mapping=True,
-        padding=True,
-        truncation=True,
-    )
-
-    train_labels = encode_tags(tag2id, train_tags, train_encodings)
-    val_labels = encode_tags(tag2id, val_tags, val_encodings)
-
-    # Last before training, generate train/val datasets
-    train_encodings.pop("offset_mapping")  # we don't want to pass this to the model
-    val_encodings.pop("offset_mapping")
-
-    # generate the datasets generators
-    train_dataset = ATCDataset_diarization(train_encodings, train_labels)
-    val_dataset = ATCDataset_diarization(val_encodings, val_labels)
+    id2tag = {id: tag for tag, id in tag2id.items()}
 
     # reduce the data in the training set in case we want to use less samples
     if args.max_train_samples is not None and args.max_train_samples != -1:
@@ -250,61 +526,84 @@ def main(args):
         indices = torch.arange(max_train_samples)
         train_dataset = torch.utils.data.Subset(train_dataset, indices)
 
-    # either, prepare the test set passed or use validation as 'final' test set
-    if args.test_data is not None:
-        test_texts, test_tags = read_atc_diarization_data(args.test_data)
-        test_encodings = tokenizer(
-            test_texts,
-            is_split_into_words=True,
-            return_offsets_mapping=True,
-            padding=True,
-            truncation=True,
+    # samples of similar length are batched together (shuffled in groups of
+    # 50 batches, so training stays stochastic), less padding per batch.
+    # With --lazy-data, getting the lengths would tokenize the whole training
+    # file at startup, so the batches are not grouped by length
+    group_by_length = not args.no_group_by_length and not args.lazy_data
+    train_lengths = None
+    if not args.lazy_data:
+        train_lengths = get_sequence_lengths(train_dataset)
+        batch_size = args.train_batch_size * args.gradient_accumulation_steps
+        # own generator, the report must not consume the global RNG (same model
+        # init and shuffling as without it)
+        generator = torch.Generator().manual_seed(args.seed)
+        orders = {
+            "random": torch.randperm(len(train_lengths), generator=generator).tolist(),
+            "length-grouped": list(
+                LengthGroupedSampler(
+                    batch_size, lengths=train_lengths, generator=generator
+                )
+            ),
+        }
+        logger.info(
+            f"*** Padding ratio if padded to the longest sample: "
+            f"{padding_ratio(train_lengths, [list(range(len(train_lengths)))]):.3f} ***"
+        )
+        for name, order in orders.items():
+            batches = [
+                order[i : i + batch_size] for i in range(0, len(order), batch_size)
+            ]
+            logger.info(
+                f"*** Padding ratio with {name} batches: "
+                f"{padding_ratio(train_lengths, batches):.3f} ***"
+            )
+
+    # new samples made of ATCO/pilot turns, composed in the DataLoader at each epoch
+    if args.augmentation_samples > 0:
+        logger.info(
+            f"*** Adding {args.augmentation_samples} augmented samples per epoch ***"
+        )
+        train_dataset = AugmentedATCDataset_diarization(
+            train_dataset,
+            tokenizer,
+            id2tag,
+            nb_samples=args.augmentation_samples,
+            seed=args.seed,
         )
-
-        test_labels = encode_tags(tag2id, test_tags, test_encodings)
-        test_encodings.pop("offset_mapping")  # we don't want to pass this to the model
-        test_dataset = ATCDataset_diarization(test_encodings, test_labels)
-    else:
-        test_dataset, test_tags = val_dataset, val_labels
 
     # Fetch the model (Token Classification)
     logger.info("*** Loading the Token Classification model (NER model) ***")
-    base_model = AutoModelForTokenClassification.from_pretrained(
-        model_name, num_labels=len(unique_tags)
-    )
+    if args.early_exit_layers is not None:
+        # exits on intermediate layers, used for adaptive depth at inference
+        config = AutoConfig.from_pretrained(model_name, num_labels=len(tag2id))
+        config.early_exit_layers = [int(l) for l in args.early_exit_layers.split()]
+        base_model = BertForEarlyExitTokenClassification.from_pretrained(
+            model_name, config=config
+        )
+    else:
+        base_model = AutoModelForTokenClassification.from_pretrained(
+            model_name, num_labels=len(tag2id)
+        )
 
     # Modify the configuration that contains the labels2ID mapping
     base_model.config.label2id = tag2id
     base_model.config.id2label = id2tag
 
-    # function to compute metrics during training
-    def compute_metrics_training(p):
-        predictions, labels = p
-        predictions = np.argmax(predictions, axis=2)
-        label_list = id2tag
-
-        # Remove ignored index (special tokens)
-        true_predictions = [
-            [label_list[p] for (p, l) in zip(prediction, label) if l != -100]
-            for prediction, label in zip(predictions, labels)
-        ]
-        true_labels = [
-            [label_list[l] for (p, l) in zip(prediction, label) if l != -100]
-            for prediction, label in zip(predictions, labels)
-        ]
+    # metrics during training, on the tag ids (no strings, no seqeval loading).
+    # The logits are reduced to tag ids batch by batch, before being gathered
+    metric = DiarizationMetrics(id2tag)
 
-        # Metrics
-        metric = load_metric("seqeval")
-        results = metric.compute(predictions=true_predictions, references=true_labels)
+    def preprocess_logits_for_metrics(logits, labels):
+        return logits.argmax(dim=-1)
 
-        return {
-            "precision": results["overall_precision"],
-            "recall": results["overall_recall"],
-            "f1": results["overall_f1"],
-            "accuracy": results["overall_accuracy"],
-        }
+    def compute_metrics_training(p):
+        metric.reset()
+        metric.update(p.predictions, p.label_ids)
+        return metric.compute()
 
     # Define TrainingArguments for Trainer object
+    early_stopping = args.early_stopping_patience > 0
     training_args = TrainingArguments(
         report_to=args.report_to,
         output_dir=output_directory,
@@ -319,25 +618,68 @@ def main(args):
         logging_dir=output_directory + "/logs",
         logging_steps=args.logging_steps,
         max_steps=args.max_steps,
-        save_steps=args.save_steps,
+        # with early stopping, the model is saved only when the metric improves
+        save_steps=args.eval_steps if early_stopping else args.save_steps,
         eval_steps=args.eval_steps,
-        save_total_limit=0,
+        save_total_limit=1 if early_stopping else 0,
+        metric_for_best_model=args.metric_for_best_model if early_stopping else None,
+        greater_is_better=args.metric_for_best_model != "jer" if early_stopping else None,
+        group_by_length=group_by_length,
     )
 
+    # stop when the validation metric does not improve in N evaluations, and
+    # evaluate less often while it does not improve
+    callbacks = []
+    if early_stopping:
+        sparse_evaluation = SparseEvaluationCallback(
+            args.eval_steps,
+            args.metric_for_best_model,
+            greater_is_better=training_args.greater_is_better,
+            max_interval=args.max_eval_interval,
+        )
+        callbacks = [
+            EarlyStoppingCallback(early_stopping_patience=args.early_stopping_patience),
+            sparse_evaluation,
+        ]
+
     # Define Trainer object
-    trainer = Trainer(
+    trainer = LengthGroupedTrainer(
+        train_lengths=train_lengths,
         model=base_model,
         args=training_args,
         train_dataset=train_dataset,
         eval_dataset=val_dataset,
         compute_metrics=compute_metrics_training,
+        preprocess_logits_for_metrics=preprocess_logits_for_metrics,
         data_collator=DataCollatorForTokenClassification(tokenizer),
+        callbacks=callbacks,
     )
 
     # fine-tune the model
     logger.info("*** Training ***")
     train_results = trainer.train()
     metrics = train_results.metrics
+    # effective (non-padding) tokens per second (the length of the augmented
+    # samples is not known in advance)
+    if args.augmentation_samples == 0 and train_lengths is not None:
+        metrics["train_tokens_per_second"] = round(
+            metrics["train_samples_per_second"] * np.mean(train_lengths), 3
+        )
+
+    # what early stopping saved, compared to training for all the steps
+    if early_stopping:
+        steps = trainer.state.global_step
+        steps_saved = trainer.state.max_steps - steps
+        cpu_hours = metrics["train_runtime"] * torch.get_num_threads() / 3600
+        metrics["early_stopping_step"] = steps
+        metrics["early_stopping_steps_saved"] = steps_saved
+        metrics["early_stopping_cpu_hours_saved"] = round(
+            cpu_hours / max(steps, 1) * steps_saved, 3
+        )
+        metrics["early_stopping_evaluations"] = sparse_evaluation.nb_evaluations
+        metrics["early_stopping_evaluations_skipped"] = (
+            steps // args.eval_steps - sparse_evaluation.nb_evaluations
+        )
 
     # saving the final model and tokenizer after fine-tuning it,
     trainer.log_metrics("train", metrics)
@@ -358,6 +700,11 @@ def main(args):
         label_list=id2tag,
         log_folder=f"{output_directory}/classification_report",
     )
+    metric.reset()
+    metric.update(raw_pred, raw_labels)
+    metrics = {f"test_{name}": value for name, value in metric.compute().items()}
+    trainer.log_metrics("test", metrics)
+    trainer.save_metrics("test", metrics)
 
     kwargs = {
         "finetuned_from": model_name,
@@ -34,6 +34,8 @@ logging_steps=1000
 eval_steps=500
 save_steps=30000
 max_steps=3000
+# stop when the validation F1 does not improve in N evaluations, 0: disabled
+early_stopping_patience=0
 
 # default is -1, which means using the full set
 max_number_of_samples="-1"
@@ -48,6 +50,9 @@ test_data=experiments/data/$dataset/test/diarization/utt2text_tags
 # empty, pass it in CLI
 validation_data=''
 
+# tokenized train/val/test sets, reused by the runs with other seeds
+cache_dir=experiments/tokenized_cache
+
 # with this we can parse options from CLI
 . data/utils/parse_options.sh
 
@@ -75,9 +80,11 @@ $cmd python3 src/train_diarization.py \
   --save-steps $save_steps \
   --eval-steps $eval_steps \
   --max-steps $max_steps \
+  --early-stopping-patience $early_stopping_patience \
   --input-model $input_model \
   --val-data "$validation_data" \
   --test-data $test_data \
+  --cache-dir $cache_dir \
   $train_data $output_folder
 
 echo "Done training a $input_model model with $dataset corpus"